@@ -11,7 +11,8 @@
 # CONDITIONS OF ANY KIND, either express or implied. See the License for the
 # specific language governing permissions and limitations under the License.
 
-from .atom import Atom, AtomError, ATOM_NS, ATOM_THR_NS, AS_NS, UpdatableAtomsList
+from .atom import Atom, AtomError, ATOM_NS, ATOM_THR_NS, AS_NS, UpdatableAtomsList, \
+                   AtomStreamParser, parse_date, parse_timestamp
 from .channel import Channel, ChannelError, InvalidChannelName
 from .client import Client, ClientError
 
@@ -12,8 +12,12 @@
 # specific language governing permissions and limitations under the License.
 
 import bisect
+import datetime
+import functools
 import logging
+import re
 import weakref
+import xml.etree.ElementTree as ET
 
 import dateutil.parser
 
@@ -31,29 +35,143 @@ class AtomError(Exception):
     """Error when handling an Atom"""
     pass
 # }}}
+# {{{ Timestamps
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+# RFC 3339 timestamps, as sent by buddycloud servers
+_TIMESTAMP_RE = re.compile(r"(\d{4})-(\d\d)-(\d\d)[Tt ](\d\d):(\d\d):(\d\d)(?:\.(\d+))?"
+                           r"(?:([Zz])|([+-])(\d\d):?(\d\d))?$")
+
+@functools.lru_cache(maxsize=4096)
+def _parse_timestamp(text):
+    """Parse a timestamp and return a (datetime, epoch in microseconds) tuple.
+
+    Timestamps without a timezone are assumed to be in UTC."""
+    text = text.strip()
+    m = _TIMESTAMP_RE.match(text)
+    if m is not None:
+        (year, month, day, hour, minute, second, frac,
+         utc, sign, tz_hour, tz_minute) = m.groups()
+        usec = 0
+        if frac is not None:
+            usec = int((frac + "00000")[:6])
+        tz = datetime.timezone.utc
+        if sign is not None:
+            offset = datetime.timedelta(hours=int(tz_hour), minutes=int(tz_minute))
+            if offset:
+                tz = datetime.timezone(-offset if sign == "-" else offset)
+        dt = datetime.datetime(int(year), int(month), int(day), int(hour),
+                               int(minute), int(second), usec, tzinfo=tz)
+    else:
+        # Not the usual format: let dateutil do the hard work
+        dt = dateutil.parser.parse(text)
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=datetime.timezone.utc)
+    return dt, (dt - EPOCH) // datetime.timedelta(microseconds=1)
+
+def parse_date(text):
+    """Parse an Atom timestamp into an aware datetime."""
+    return _parse_timestamp(text)[0]
+
+def parse_timestamp(text):
+    """Parse an Atom timestamp into an integer number of microseconds since the
+    epoch, suitable for fast comparisons."""
+    return _parse_timestamp(text)[1]
+# }}}
 # {{{ Atom element
 class Atom:
-    """Basic class for easier handling of Atom elements"""
-
-    def __init__(self, elt):
-        self.elt = elt
-
-    def get_child(self, tag, ns=ATOM_NS):
-        return self.elt.find("{{{}}}{}".format(ns, tag))
+    """Basic class for easier handling of Atom elements.
+
+    All the interesting fields are extracted in a single pass when the Atom is
+    created, so reading them later (e.g. when sorting thousands of posts) does
+    not walk the XML tree again. The element tree is not kept: if keep_xml is
+    True, the entry is serialized and kept as text in Atom.xml, which is much
+    smaller, and Atom.elt parses it again when needed. Atoms that may be
+    cached must keep it."""
+
+    __slots__ = ("xml", "id", "author", "content", "published", "published_ts",
+                 "updated", "updated_ts", "in_reply_to", "link", "object_type",
+                 "verb", "tombstone")
+
+    _TAG_ENTRY       = "{{{}}}entry".format(ATOM_NS)
+    _TAG_ID          = "{{{}}}id".format(ATOM_NS)
+    _TAG_AUTHOR      = "{{{}}}author".format(ATOM_NS)
+    _TAG_NAME        = "{{{}}}name".format(ATOM_NS)
+    _TAG_URI         = "{{{}}}uri".format(ATOM_NS)
+    _TAG_CONTENT     = "{{{}}}content".format(ATOM_NS)
+    _TAG_PUBLISHED   = "{{{}}}published".format(ATOM_NS)
+    _TAG_UPDATED     = "{{{}}}updated".format(ATOM_NS)
+    _TAG_LINK        = "{{{}}}link".format(ATOM_NS)
+    _TAG_IN_REPLY_TO = "{{{}}}in-reply-to".format(ATOM_THR_NS)
+    _TAG_OBJECT      = "{{{}}}object".format(AS_NS)
+    _TAG_OBJECT_TYPE = "{{{}}}object-type".format(AS_NS)
+    _TAG_VERB        = "{{{}}}verb".format(AS_NS)
+    _TAG_TOMBSTONE   = "{{{}}}deleted-entry".format(TOMBSTONE_NS)
+
+    def __init__(self, elt, keep_xml=False):
+        self.xml = ET.tostring(elt, encoding="unicode") if keep_xml else None
+        self.id = None
+        self.author = None
+        self.content = None
+        self.published = None
+        self.published_ts = None
+        self.updated = None
+        self.updated_ts = None
+        self.in_reply_to = None
+        self.link = None
+        self.object_type = None
+        self.verb = None
+        self.tombstone = (elt.tag == Atom._TAG_TOMBSTONE)
+
+        for child in elt:
+            tag = child.tag
+            if tag == Atom._TAG_ID:
+                self.id = child.text
+            elif tag == Atom._TAG_AUTHOR:
+                self.author = Atom._parse_author(child)
+            elif tag == Atom._TAG_CONTENT:
+                self.content = child.text
+            elif tag == Atom._TAG_PUBLISHED:
+                self.published, self.published_ts = _parse_timestamp(child.text)
+            elif tag == Atom._TAG_UPDATED:
+                self.updated, self.updated_ts = _parse_timestamp(child.text)
+            elif tag == Atom._TAG_IN_REPLY_TO:
+                if "ref" in child.attrib:
+                    self.in_reply_to = child.attrib["ref"]
+                else:
+                    log.warning("Atom with in-reply-to element without ref attribute")
+            elif tag == Atom._TAG_LINK:
+                if self.link is None:
+                    self.link = child.attrib
+            elif tag == Atom._TAG_OBJECT:
+                ot = child.find(Atom._TAG_OBJECT_TYPE)
+                if ot is not None:
+                    self.object_type = ot.text
+            elif tag == Atom._TAG_VERB:
+                self.verb = child.text
+
+        # Tombstones don't have an author nor a content, and that's fine.
+        if self.author is None:
+            if not self.tombstone:
+                # Something is terribly wrong.
+                log.warning("Atom without author")
+            self.author = "[unknown author]"
+
+        if self.content is None:
+            if not self.tombstone:
+                log.warning("Atom without content")
+            self.content = ""
+        else:
+            self.content = self.content.strip()
 
-    @property
-    def author(self):
-        a = self.get_child("author")
-        if a is None:
-            # Something is terribly wrong.
-            log.warning("Atom without author")
-            return "[unknown author]"
-        name = a.find("{{{}}}name".format(ATOM_NS))
+    @staticmethod
+    def _parse_author(a):
+        name = a.find(Atom._TAG_NAME)
         if name is not None:
             return name.text
         else:
             # This should NOT happen >:-(
-            uri = a.find("{{{}}}uri".format(ATOM_NS))
+            uri = a.find(Atom._TAG_URI)
             if uri is not None:
                 log.warning("Atom without author name")
                 if uri.text.startswith("acct:"):
@@ -67,60 +185,68 @@ class Atom:
                 return "[unknown author]"
 
     @property
-    def content(self):
-        cnt = self.get_child("content")
-        if cnt is None:
-            log.warning("Atom without content")
-            return ""
-        text = self.get_child("content").text
-        if text is None:
-            log.warning("Atom without content text")
-            text = ""
-        return text.strip()
-
-    @property
-    def id(self): return self.get_child("id").text
-
-    @property
-    def in_reply_to(self):
-        irt = self.get_child("in-reply-to", ATOM_THR_NS)
-        if irt is not None:
-            if "ref" in irt.attrib:
-                return irt.attrib["ref"]
-            else:
-                log.warning("Atom with in-reply-to element without ref attribute")
-
-    @property
-    def link(self): return self.get_child("link").attrib
-
-    @property
-    def object_type(self):
-        o = self.get_child("object", AS_NS)
-        return o.find("{{{}}}object-type".format(AS_NS)).text
+    def elt(self):
+        if self.xml is None:
+            raise AtomError("The entry of Atom {} was not kept".format(self.id))
+        return ET.fromstring(self.xml)
 
-    @property
-    def published(self):
-        t = self.get_child("published").text
-        return dateutil.parser.parse(t)
+    def get_child(self, tag, ns=ATOM_NS):
+        return self.elt.find("{{{}}}{}".format(ns, tag))
 
-    @property
-    def updated(self):
-        t = self.get_child("updated").text
-        return dateutil.parser.parse(t)
+    def __eq__(self, other):
+        return isinstance(other, Atom) and self.id == other.id
 
-    @property
-    def tombstone(self):
-        ts_tag = "{" + TOMBSTONE_NS + "}deleted-entry"
-        return self.elt.tag == ts_tag
+    def __lt__(self, other):
+        return self.published_ts > other.published_ts # ">" to sort by newest first
+# }}}
+# {{{ Streaming Atom parser
+class AtomStreamParser:
+    """Incrementally extract Atoms from XML data, as it arrives.
 
-    @property
-    def verb(self): return self.get_child("verb", AS_NS).text
+    Data is fed in chunks of any size, and the Atoms found in every complete
+    <entry> (or tombstone) element are returned. Finished elements are dropped
+    from the document tree as soon as possible, so that parsing thousands of
+    entries does not require keeping them all in memory."""
 
-    def __eq__(self, other):
-        return type(other) is Atom and self.id == other.id
+    _ENTRY_TAGS = (Atom._TAG_ENTRY, Atom._TAG_TOMBSTONE)
 
-    def __lt__(self, other):
-        return self.published > other.published # ">" to sort by newest first
+    def __init__(self):
+        self._parser = ET.XMLPullParser(events=("start", "end"))
+        self._stack = []
+        self._entry_depth = None
+
+    def feed(self, data):
+        """Feed some XML data to the parser. Return the list of new Atoms."""
+        self._parser.feed(data)
+        return self._read_events()
+
+    def close(self):
+        """Tell the parser that there is no more data. Return the list of
+        remaining Atoms."""
+        self._parser.close()
+        return self._read_events()
+
+    def _read_events(self):
+        atoms = []
+        for (event, elem) in self._parser.read_events():
+            if event == "start":
+                if self._entry_depth is None and elem.tag in self._ENTRY_TAGS:
+                    self._entry_depth = len(self._stack)
+                self._stack.append(elem)
+                continue
+
+            self._stack.pop()
+            if self._entry_depth is not None:
+                if len(self._stack) > self._entry_depth:
+                    # Inside an entry: keep it for now
+                    continue
+                self._entry_depth = None
+                atoms.append(Atom(elem))
+
+            # Drop finished elements from the tree
+            if len(self._stack) > 0:
+                self._stack[-1].remove(elem)
+        return atoms
 # }}}
 # {{{ Updatable Atoms list
 class UpdatableAtomsList:
@@ -144,6 +270,7 @@ class UpdatableAtomsList:
 
     def __init__(self):
         self._list = []
+        self._index = {} # id -> Atom, for fast lookups
         self._iterators = weakref.WeakSet()
 
     def __iter__(self):
@@ -157,25 +284,35 @@ class UpdatableAtomsList:
         return len(self._list)
 
     def __contains__(self, other):
-        if type(other) is not Atom:
+        if not isinstance(other, Atom):
             return False
-        for a in self._list:
-            if a.id == other.id:
-                return True
-        return False
+        return other.id in self._index
+
+    def _find(self, atom):
+        # Atoms with the same date are contiguous, so a bisect followed by a
+        # short scan is enough to find the position of a given Atom.
+        pos = bisect.bisect_left(self._list, atom)
+        while pos < len(self._list) and self._list[pos] is not atom:
+            pos += 1
+        if pos >= len(self._list):
+            # Should not happen, unless an Atom date was changed in place
+            log.warning("Atom %s not found at its expected position", atom.id)
+            pos = self._list.index(atom)
+        return pos
 
     def add(self, elt):
-        a = Atom(elt)
+        a = Atom(elt, keep_xml=True)
         if a.object_type not in ("note", "comment"):
             raise AtomError("Unknown item type: {}".format(a.object_type))
 
         # If Atom already present, remove it so we can update it
-        if a in self:
+        if a.id in self._index:
             self.remove(a.id)
 
         # Find insertion position, and insert
         pos = bisect.bisect_left(self._list, a)
         self._list.insert(pos, a)
+        self._index[a.id] = a
 
         # Update all iterators
         for it in self._iterators:
@@ -184,21 +321,70 @@ class UpdatableAtomsList:
 
         return a
 
+    def add_many(self, elts):
+        """Add several Atoms at once. The new Atoms are merged into the list in
+        a single pass, and iterators are only updated once. Return the list of
+        accepted Atoms, newest first."""
+        batch = {}
+        for elt in elts:
+            # These Atoms are written to the cache, so keep their entry
+            a = Atom(elt, keep_xml=True)
+            if a.object_type not in ("note", "comment"):
+                log.warning("Unknown item type: %s", a.object_type)
+                continue
+            # If the same Atom appears twice, the last one wins
+            batch[a.id] = a
+        if len(batch) == 0:
+            return []
+        atoms = sorted(batch.values())
+
+        # Drop the old versions of updated Atoms
+        old_len = len(self._list)
+        removed = sorted(self._find(self._index[id_]) for id_ in batch if id_ in self._index)
+        kept = self._list
+        if len(removed) > 0:
+            kept = kept[:]
+            for pos in reversed(removed):
+                del kept[pos]
+
+        # Merge the new Atoms into the list, copying whole slices of the old
+        # one between insertion positions
+        positions = [bisect.bisect_left(kept, a) for a in atoms]
+        new_list = []
+        prev = 0
+        for (a, pos) in zip(atoms, positions):
+            new_list.extend(kept[prev:pos])
+            new_list.append(a)
+            prev = pos
+        new_list.extend(kept[prev:])
+
+        self._list = new_list
+        self._index.update(batch)
+
+        # Update all iterators. An iterator now points to the last kept Atom it
+        # has already seen, shifted by the number of new Atoms inserted before
+        # it -- just like remove() and add() would do.
+        for it in self._iterators:
+            if it._idx >= old_len:
+                it._idx += len(new_list) - old_len
+            elif it._idx >= 0:
+                k = it._idx - bisect.bisect_right(removed, it._idx)
+                it._idx = k + bisect.bisect_right(positions, k)
+
+        return atoms
+
     def remove(self, id_):
         # Find Atom with given id
-        pos = None
-        for (i, a) in enumerate(self._list):
-            if a.id == id_:
-                pos = i
-                break
-        if pos is None:
+        a = self._index.pop(id_, None)
+        if a is None:
             return
+        pos = self._find(a)
 
         # Remove it and update all iterators
         del self._list[pos]
         for it in self._iterators:
-            if it.idx >= pos:
-                it.idx -= 1
+            if it._idx >= pos:
+                it._idx -= 1
 # }}}
 
 # {{{ Atom in SleekXMPP stanzas
@@ -16,9 +16,7 @@ from xml.etree import cElementTree as ET
 import logging
 import threading
 
-import dateutil.parser
-
-from bccc.client import Atom, ATOM_NS, ATOM_THR_NS, UpdatableAtomsList
+from bccc.client import Atom, AtomError, ATOM_NS, ATOM_THR_NS, UpdatableAtomsList, parse_date
 
 log = logging.getLogger(__name__)
 log.addHandler(logging.NullHandler())
@@ -104,11 +102,16 @@ class Channel:
         # Incoming entries: add them and trigger the callback
         if len(entries) == 0:
             return
-        atoms = []
-        for elt in entries:
-            a = self.atoms.add(elt)
-            if a is not None:
-                atoms.append(a)
+        with self.atoms_lock:
+            if len(entries) == 1:
+                # A single live post: no need to merge it into a new list
+                try:
+                    atoms = [self.atoms.add(entries[0])]
+                except AtomError as e:
+                    log.warning("%s", e)
+                    atoms = []
+            else:
+                atoms = self.atoms.add_many(entries)
         if len(atoms) > 0 and self.callback_post is not None:
             self.callback_post(atoms)
 
@@ -140,20 +143,16 @@ class Channel:
                 if ik in val:
                     config[dk] = val[ik].strip()
             if "creation" in config:
-                config["creation"] = dateutil.parser.parse(config["creation"])
+                config["creation"] = parse_date(config["creation"])
 
             if self.callback_config is not None:
                 self.callback_config(config)
     # }}}
     # {{{ Internal helpers
     def _items_to_atoms(self, items, callback=None):
-        atoms = []
         with self.atoms_lock:
-            for item in items["pubsub"]["items"]:
-                elt = item.get_payload()
-                a = self.atoms.add(elt)
-                if a is not None:
-                    atoms.append(a)
+            elts = [item.get_payload() for item in items["pubsub"]["items"]]
+            atoms = self.atoms.add_many(elts)
         if len(atoms) > 0 and callback is not None:
             callback(atoms)
         return atoms
@@ -21,7 +21,7 @@ from sleekxmpp.exceptions import IqError
 from sleekxmpp.xmlstream.matcher import MatchXPath
 from sleekxmpp.xmlstream.handler import Callback
 
-from bccc.client.channel import Channel
+from bccc.client.channel import Channel, ChannelError
 
 log = logging.getLogger(__name__)
 log.addHandler(logging.NullHandler())
@@ -54,6 +54,11 @@ class Client(sleekxmpp.ClientXMPP):
         self.inbox_jid = None
         self.channels = {}
 
+        # Posts received from MAM and not handed to their channel yet:
+        # channel JID -> list of entries
+        self.mam_posts = {}
+        self.mam_lock = threading.Lock()
+
         self.register_plugin("xep_0004") # Data forms
         self.register_plugin("xep_0030") # Service Discovery
         self.register_plugin("xep_0059") # Result Set Management
@@ -140,6 +145,11 @@ class Client(sleekxmpp.ClientXMPP):
         return chan
     # }}}
     # {{{ MAM handling
+    # MAM replies come one message per post. Posts are handed to their
+    # channel in batches of up to mam_batch_size, and when the MAM query is
+    # over.
+    mam_batch_size = 100
+
     def handle_mam_reply(self, msg):
         # This is ugly, probably slow and too convoluted, and should be done in
         # a clean SleekXMPP plugin instead.
@@ -151,6 +161,13 @@ class Client(sleekxmpp.ClientXMPP):
         evt = msg3["pubsub_event"]
 
         for evt2 in evt["substanzas"]:
+            if self._queue_mam_posts(evt2):
+                continue
+
+            # Keep the events in order: the posts received before this event
+            # must be handled first
+            self.flush_mam_posts()
+
             # Encapsulate this in a message and inject it in the stream
             new_msg = self.Message()
             new_msg["from"] = msg3["from"]
@@ -161,6 +178,43 @@ class Client(sleekxmpp.ClientXMPP):
             # it is run.
             self._XMLStream__spawn_event(new_msg.xml)
 
+        with self.mam_lock:
+            full = sum(map(len, self.mam_posts.values())) >= Client.mam_batch_size
+        if full:
+            self.flush_mam_posts()
+
+    def _queue_mam_posts(self, evt):
+        # Queue the posts of a MAM items event. Return False if this is any
+        # other event (retraction, status, configuration...).
+        if not isinstance(evt, xep_0060.stanza.EventItems):
+            return False
+        node = evt["node"]
+        if not node.startswith("/user/") or not node.endswith("/posts"):
+            return False
+        jid = node[6:-6]
+        if len(jid) == 0:
+            return False
+        items = evt["substanzas"]
+        if len(items) == 0 or not all(isinstance(item, xep_0060.stanza.EventItem) for item in items):
+            return False
+
+        payloads = [item["payload"] for item in items]
+        with self.mam_lock:
+            self.mam_posts.setdefault(jid, []).extend(p for p in payloads if p is not None)
+        return True
+
+    def flush_mam_posts(self):
+        """Hand the posts received from MAM so far to their channels."""
+        with self.mam_lock:
+            posts, self.mam_posts = self.mam_posts, {}
+        for (jid, entries) in posts.items():
+            log.debug("MAM: %d posts for %s", len(entries), jid)
+            try:
+                chan = self.get_channel(jid)
+            except ChannelError:
+                continue
+            chan.handle_post_event(entries)
+
     def mam(self, start=None, end=None):
         self.ready()
 
@@ -175,7 +229,8 @@ class Client(sleekxmpp.ClientXMPP):
             elt = ET.SubElement(query, "end")
             elt.text = end.astimezone(datetime.timezone.utc).isoformat()
 
-        mam_iq.send(block=False)
+        # The reply comes after all the messages
+        mam_iq.send(callback=lambda iq: self.flush_mam_posts())
     # }}}
     # {{{ PubSub handling
     def handle_pubsub_publish(self, msg):
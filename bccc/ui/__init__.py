@@ -11,7 +11,7 @@
 # CONDITIONS OF ANY KIND, either express or implied. See the License for the
 # specific language governing permissions and limitations under the License.
 
-from .cache import Cache
+from .cache import Cache, CacheWarmUp
 from .item import ItemWidget, PostWidget, ReplyWidget, NewPostWidget, NewReplyWidget, EditPostWidget, EditReplyWidget
 from .sidebar import ChannelBox, ChannelsList
 from .thread import ThreadsBox
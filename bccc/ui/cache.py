@@ -11,204 +11,1567 @@
 # CONDITIONS OF ANY KIND, either express or implied. See the License for the
 # specific language governing permissions and limitations under the License.
 
+import atexit
+import bisect
+import collections
 import datetime
+import dbm
+import functools
+import json
 import logging
 import os
 import os.path
-import random
+import pickle
+import re
 import shelve
+import sqlite3
 import threading
+import time
 import xml.etree.ElementTree as ET
+import zlib
 
 import dateutil.tz
 
-from bccc.client import Atom
+from bccc.client import Atom, AtomError, AtomStreamParser
 
 log = logging.getLogger(__name__)
 log.addHandler(logging.NullHandler())
 
+# {{{ Instrumentation
+class Histogram:
+    """Distribution of some values, in power-of-two buckets."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.buckets = collections.Counter() # bucket -> count, with 2**(bucket-1) <= value < 2**bucket
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        self.buckets[int(value).bit_length()] += 1
+
+    def percentile(self, p):
+        # Upper bound of the bucket holding the p-th percentile
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= self.count * p / 100:
+                return min(2 ** bucket, self.max)
+        return 0
+
+    def summary(self):
+        if self.count == 0:
+            return {"count": 0}
+        return {"count": self.count, "total": self.total, "mean": self.total / self.count,
+                "p50": self.percentile(50), "p90": self.percentile(90),
+                "p99": self.percentile(99), "max": self.max}
+
+class CacheStats:
+    """Counters and histograms about the cache. Durations are in microseconds
+    and sizes in bytes.
+
+    Counters:
+    - items_listed: item headers read by Cache.items
+    - entries_read, entries_parsed: entries read and parsed from the database
+    - index_hits, index_misses: accesses to the in-memory index of a channel,
+      and how many of them had to load it from the database first
+    - add_new, add_updated, add_duplicate: outcomes of Cache.add_items()
+    - items_evicted: items removed to stay within the budget
+    - bytes_written: size of the entries written to the database (compressed)
+    - xml_bytes_written: size of the same entries before compression
+
+    Histograms:
+    - read_time: time spent reading and parsing entries
+    - entry_size: size of the entries written to the database
+    - sync_time: time spent applying pending writes and committing
+    - lock_wait: time spent waiting for a store lock held by another thread"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = collections.Counter()
+            self.histograms = collections.defaultdict(Histogram)
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def record(self, name, value):
+        with self._lock:
+            self.histograms[name].add(value)
+
+    def snapshot(self):
+        """Return the current values, as a dictionary."""
+        with self._lock:
+            stats = dict(self.counters)
+            for (name, hist) in self.histograms.items():
+                stats[name] = hist.summary()
+            return stats
+
+    def dump(self, level=logging.INFO):
+        """Write the current values to the log."""
+        stats = self.snapshot()
+        log.log(level, "Cache statistics:")
+        for name in sorted(stats):
+            value = stats[name]
+            if isinstance(value, dict):
+                value = ", ".join("{}={:.0f}".format(k, v) for (k, v) in value.items())
+            log.log(level, "  %s: %s", name, value)
+
+cache_stats = CacheStats()
+
+class TimedRLock:
+    """A re-entrant lock that records how long it has been waited for."""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+
+    def acquire(self, blocking=True, timeout=-1):
+        if self._lock.acquire(blocking=False):
+            return True
+        start = time.perf_counter()
+        acquired = self._lock.acquire(blocking, timeout)
+        cache_stats.record("lock_wait", (time.perf_counter() - start) * 1000000)
+        return acquired
+
+    def release(self):
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+# }}}
+# {{{ Write-behind flush scheduler
+class FlushScheduler:
+    """A single background thread that commits the changes made to all the
+    cache stores.
+
+    A dirty store is flushed once it has been dirty for max_latency seconds,
+    or as soon as more than max_dirty_bytes have been written to it. All the
+    stores are flushed when the program exits.
+
+    Once no store has been changed for idle_delay seconds, the stores flushed
+    in the meantime get a chance to do some maintenance."""
+
+    max_latency = 5.0
+    max_dirty_bytes = 256 * 1024
+    idle_delay = 60.0
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._dirty = {} # store -> [time of first change, bytes written]
+        self._idle = set() # stores flushed since the last maintenance
+        self._last_change = time.monotonic()
+        self._thread = None
+        self._stopped = False
+
+        # Statistics
+        self.flush_count = 0
+        self.flush_time = 0.0
+
+        atexit.register(self.stop)
+
+    def mark_dirty(self, store, nbytes=0):
+        with self._cond:
+            self._last_change = time.monotonic()
+            if store in self._dirty:
+                self._dirty[store][1] += nbytes
+            else:
+                self._dirty[store] = [time.monotonic(), nbytes]
+            if self._thread is None and not self._stopped:
+                self._thread = threading.Thread(target=self._run, name="cache flush")
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify()
+
+    def forget(self, store):
+        with self._cond:
+            self._dirty.pop(store, None)
+            self._idle.discard(store)
+
+    def _due_stores(self, now):
+        return [store for (store, (since, nbytes)) in self._dirty.items()
+                if now - since >= self.max_latency or nbytes >= self.max_dirty_bytes]
+
+    def _run(self):
+        while True:
+            with self._cond:
+                idle = []
+                while not self._stopped:
+                    now = time.monotonic()
+                    due = self._due_stores(now)
+                    if len(due) > 0:
+                        break
+                    timeout = None
+                    if len(self._dirty) > 0:
+                        oldest = min(since for (since, _) in self._dirty.values())
+                        timeout = max(0, oldest + self.max_latency - now)
+                    elif len(self._idle) > 0:
+                        timeout = self._last_change + self.idle_delay - now
+                        if timeout <= 0:
+                            idle = list(self._idle)
+                            self._idle.clear()
+                            break
+                    self._cond.wait(timeout)
+                if self._stopped:
+                    return
+                for store in due:
+                    del self._dirty[store]
+            self._flush(due)
+            for store in idle:
+                try:
+                    store.idle()
+                except Exception:
+                    log.exception("Could not do the maintenance of cache %s", store.fn)
+
+    def _flush(self, stores):
+        flushed = []
+        for store in stores:
+            start = time.monotonic()
+            try:
+                store.sync()
+            except Exception:
+                # Keep the thread alive, and try again later
+                log.exception("Could not flush cache %s", store.fn)
+                self.mark_dirty(store)
+                continue
+            self.flush_time += time.monotonic() - start
+            self.flush_count += 1
+            flushed.append(store)
+        with self._cond:
+            self._idle.update(flushed)
+
+    def flush_all(self):
+        with self._cond:
+            stores = list(self._dirty.keys())
+            self._dirty.clear()
+        self._flush(stores)
+
+    def stop(self):
+        with self._cond:
+            if self._stopped:
+                return
+            self._stopped = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush_all()
+        log.info("Cache flushed %d times in %.3f seconds", self.flush_count, self.flush_time)
+
+flush_scheduler = FlushScheduler()
+# }}}
+# {{{ Configuration
+def configure(conf):
+    """Apply the [cache] section of the configuration file."""
+    if conf.has_option("cache", "flush_latency"):
+        flush_scheduler.max_latency = conf.getfloat("cache", "flush_latency")
+    if conf.has_option("cache", "flush_max_dirty_bytes"):
+        flush_scheduler.max_dirty_bytes = conf.getint("cache", "flush_max_dirty_bytes")
+    if conf.has_option("cache", "max_items"):
+        CacheStore.max_items = conf.getint("cache", "max_items")
+    if conf.has_option("cache", "max_size"):
+        CacheStore.max_bytes = conf.getint("cache", "max_size")
+    if conf.has_option("cache", "min_channel_items"):
+        CacheStore.min_channel_items = conf.getint("cache", "min_channel_items")
+# }}}
+# {{{ Entry compression
+# Entries are stored as raw deflate streams, preceded by a format marker byte,
+# and compressed with a preset dictionary made of the XML fragments all the
+# entries have in common. Entries written by older versions are plain text and
+# are read as-is.
+#
+# Never change _ENTRY_ZDICT: the existing entries could not be decompressed
+# anymore. Add a new format marker instead.
+_ENTRY_ZLIB = b"\x01"
+_ENTRY_ZDICT = "".join((
+    '<ns0:link rel="self" href="xmpp:',
+    '<ns0:link rel="alternate" href="',
+    '<ns0:link rel="edit" href="',
+    '<ns1:in-reply-to ref="tag:',
+    '<ns2:object><ns2:object-type>comment</ns2:object-type></ns2:object><ns2:verb>post</ns2:verb>',
+    '<ns1:object><ns1:object-type>note</ns1:object-type></ns1:object><ns1:verb>post</ns1:verb>',
+    '<ns0:entry xmlns:ns0="http://www.w3.org/2005/Atom" xmlns:ns1="http://purl.org/syndication/thread/1.0" '
+    'xmlns:ns2="http://activitystrea.ms/spec/1.0/">',
+    '<ns0:entry xmlns:ns0="http://www.w3.org/2005/Atom" xmlns:ns1="http://activitystrea.ms/spec/1.0/">',
+    '<ns0:id>tag:',
+    ',2012:/user/',
+    '/posts:',
+    '</ns0:id><ns0:author><ns0:name>',
+    '</ns0:name></ns0:author><ns0:content>',
+    '</ns0:content><ns0:published>2012-',
+    '.000000+00:00</ns0:published><ns0:updated>2012-',
+    '.000000+00:00</ns0:updated>',
+    '</ns0:entry>',
+)).encode("utf-8")
+
+def _compress_entry(xml):
+    comp = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15, zdict=_ENTRY_ZDICT)
+    return _ENTRY_ZLIB + comp.compress(xml.encode("utf-8")) + comp.flush()
+
+def _decompress_entry(data):
+    if isinstance(data, str):
+        # Uncompressed entry from an older version
+        return data
+    if data[:1] == _ENTRY_ZLIB:
+        decomp = zlib.decompressobj(-15, zdict=_ENTRY_ZDICT)
+        return (decomp.decompress(data[1:]) + decomp.flush()).decode("utf-8")
+    raise ValueError("Unknown cache entry format {!r}".format(data[:1]))
+# }}}
+# {{{ Account-wide SQLite store
+class CacheStore:
+    """The SQLite database holding the cache of all the channels of an account.
+
+    There is only one store per account, shared by all the Cache instances of
+    its channels. All accesses to the database must hold the store lock."""
+
+    filename = "cache.sqlite"
+    schema_version = 5
+    max_loaded_indexes = 32
+
+    # Account-wide budget: when the cache holds more than max_items items or
+    # max_bytes bytes of entries, items are evicted until it is back under
+    # evict_ratio of the budget. Each channel keeps at least its
+    # min_channel_items most recent items.
+    max_items = 20000
+    max_bytes = 64 * 1024 * 1024
+    min_channel_items = 20
+    evict_ratio = 0.9
+
+    # Compacting the database blocks it for seconds, so it's only done by
+    # `bccc --check-cache`. It is suggested in the log when more than
+    # compact_ratio of the database is free space, and at least
+    # compact_min_bytes.
+    compact_ratio = 0.25
+    compact_min_bytes = 1024 * 1024
+
+    # Changes are appended to the write-ahead log, which SQLite folds into the
+    # database file (checkpoints) once it holds 1000 pages. It is also
+    # checkpointed and emptied when the cache is idle. After a checkpoint, the
+    # log file is truncated to wal_size_limit bytes.
+    wal_size_limit = 4 * 1024 * 1024
+
+    # The flush thread holds the store lock for about lock_slice seconds at
+    # a time while applying the pending writes. Items are queued in chunks
+    # of write_chunk_size, so that each operation is short.
+    lock_slice = 0.01
+    write_chunk_size = 64
+
+    # Entries can only be deleted from a contentless full-text index by
+    # rowid since SQLite 3.43. Before that, their indexed text is needed.
+    _contentless_delete = sqlite3.sqlite_version_info >= (3, 43, 0)
+
+    _stores = {}
+    _stores_lock = threading.Lock()
+
+    @classmethod
+    def open(cls, account_cache_dir):
+        with cls._stores_lock:
+            store = cls._stores.get(account_cache_dir)
+            if store is None:
+                store = cls(account_cache_dir)
+                cls._stores[account_cache_dir] = store
+            store._users += 1
+            return store
+
+    def __init__(self, account_cache_dir):
+        self.dir = account_cache_dir
+        self.fn = os.path.join(account_cache_dir, CacheStore.filename)
+        self.lock = TimedRLock()
+        self._users = 0
+
+        # Write-behind queue: operations waiting to be applied to the
+        # database by the flush thread, as (channel, function, args, prepare)
+        # tuples
+        self._pending = collections.deque()
+
+        # Summary of all the channels (config, status, last update), loaded
+        # in one go on first use
+        self._summary = None
+
+        # Caches with a loaded items index, least recently used first
+        self._loaded = collections.OrderedDict()
+
+        # Number of items and size of their entries, loaded on first use
+        self._totals = None
+
+        # Names of the files in the account cache directory, to look for old
+        # shelve caches without checking each channel separately
+        self._files = None
+
+        # Is the full-text index available? (SQLite may be built without FTS5)
+        # Can its entries be deleted by rowid?
+        self._fts = True
+        self._fts_delete = False
+
+        self.db = None
+        try:
+            self._open_db()
+        except sqlite3.OperationalError:
+            # Locked database, I/O or permission error: the database itself
+            # may be fine (and in use by another process), so leave it alone
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+            raise
+        except sqlite3.DatabaseError:
+            # "file is not a database", "database disk image is malformed",
+            # or a failed quick_check
+            log.exception("Cache database %s is corrupted", self.fn)
+            self._recover()
+
+    def _open_db(self):
+        log.debug("Opening cache database %s", self.fn)
+        self.db = sqlite3.connect(self.fn, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("PRAGMA journal_size_limit={:d}".format(CacheStore.wal_size_limit))
+
+        start = time.monotonic()
+        result = self.db.execute("PRAGMA quick_check").fetchone()[0]
+        if result != "ok":
+            raise sqlite3.DatabaseError("quick_check failed: " + result)
+        log.debug("Checked %s in %.3f seconds", self.fn, time.monotonic() - start)
+
+        self._create_schema()
+        self.check()
+
+    def _recover(self):
+        # This is only a cache: move the broken database away and start again
+        # with an empty one
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+        for ext in ("", "-wal", "-shm"):
+            if os.path.isfile(self.fn + ext):
+                os.replace(self.fn + ext, self.fn + ".corrupted" + ext)
+        log.warning("Moved corrupted cache database to %s.corrupted", self.fn)
+        self._open_db()
+
+    def _create_schema(self):
+        with self.lock:
+            version = self.db.execute("PRAGMA user_version").fetchone()[0]
+            if version == CacheStore.schema_version:
+                return
+            elif version > CacheStore.schema_version:
+                log.warning("Cache database %s has a newer schema (%d)", self.fn, version)
+                return
+
+            if version < 1:
+                log.info("Creating cache database schema in %s", self.fn)
+                self.db.executescript("""
+                    CREATE TABLE IF NOT EXISTS channels (
+                        jid    TEXT PRIMARY KEY,
+                        config BLOB,
+                        status TEXT
+                    );
+                    CREATE TABLE IF NOT EXISTS items (
+                        channel TEXT NOT NULL,
+                        id      TEXT NOT NULL,
+                        updated INTEGER NOT NULL,
+                        entry   TEXT NOT NULL,
+                        PRIMARY KEY (channel, id)
+                    );
+                    CREATE INDEX IF NOT EXISTS items_by_date ON items (channel, updated);
+                """)
+            if version < 2:
+                # Header fields, so that threads can be built without parsing
+                # the entries
+                log.info("Adding header fields to cache database %s", self.fn)
+                for col in ("published INTEGER", "author TEXT", "in_reply_to TEXT",
+                            "object_type TEXT", "tombstone INTEGER"):
+                    self.db.execute("ALTER TABLE items ADD COLUMN " + col)
+                rows = self.db.execute("SELECT rowid, entry FROM items").fetchall()
+                for (rowid, data) in rows:
+                    a = Atom(ET.fromstring(_decompress_entry(data)))
+                    self.db.execute("UPDATE items SET published=?, author=?, in_reply_to=?, object_type=?, tombstone=? "
+                                    "WHERE rowid=?", Cache._atom_headers(a) + (rowid,))
+            if version < 3:
+                # Entry sizes and channel access times, for the global budget
+                log.info("Adding budget fields to cache database %s", self.fn)
+                self.db.executescript("""
+                    ALTER TABLE items ADD COLUMN size INTEGER NOT NULL DEFAULT 0;
+                    UPDATE items SET size=LENGTH(entry);
+                    ALTER TABLE channels ADD COLUMN last_access INTEGER;
+                """)
+            if version < 5:
+                # Full-text index of the posts content and authors. Version 4
+                # stored a copy of the indexed text.
+                log.info("Creating full-text index in cache database %s", self.fn)
+                self._create_fts()
+
+            self.db.execute("PRAGMA user_version = {:d}".format(CacheStore.schema_version))
+            self.db.commit()
+
+        if self._fts:
+            # The table may be missing if the schema was created by a SQLite
+            # without FTS5
+            row = self.db.execute("SELECT sql FROM sqlite_master WHERE name='items_fts'").fetchone()
+            self._fts = row is not None
+            self._fts_delete = self._fts and "contentless_delete" in row[0]
+            if self._fts_delete and not CacheStore._contentless_delete:
+                log.info("Full-text index of %s was created by a newer SQLite: rebuilding it", self.fn)
+                with self.lock:
+                    self._create_fts()
+                    self.db.commit()
+
+    def _create_fts(self):
+        # The index has the same rowids as the items table, which search()
+        # joins on. It is contentless: it doesn't store the indexed text.
+        self.db.execute("DROP TABLE IF EXISTS items_fts")
+        options = "content=''"
+        if CacheStore._contentless_delete:
+            options += ", contentless_delete=1"
+        try:
+            self.db.execute("CREATE VIRTUAL TABLE items_fts USING fts5(author, content, {}, "
+                            "tokenize='unicode61 remove_diacritics 2')".format(options))
+        except sqlite3.OperationalError as e:
+            if "no such module" not in str(e):
+                raise
+            log.warning("SQLite has no FTS5 support: cache search is disabled")
+            self._fts = False
+            return
+        self._fts = True
+        self._fts_delete = CacheStore._contentless_delete
+        rows = self.db.execute("SELECT rowid, entry FROM items WHERE NOT tombstone").fetchall()
+        for (rowid, data) in rows:
+            atom = self._decode_entry(rowid, data)
+            if atom is not None:
+                self.index_item(rowid, atom)
+
+    def release(self):
+        with CacheStore._stores_lock:
+            self._users -= 1
+            if self._users > 0:
+                return
+            del CacheStore._stores[self.dir]
+        with self.lock:
+            flush_scheduler.forget(self)
+            self.sync()
+            log.debug("Closing cache database %s", self.fn)
+            self.db.close()
+            self.db = None
+
+    def sync(self, *args):
+        start = time.perf_counter()
+        with self.lock:
+            if self.db is None:
+                return
+            prepare = [op[3] for op in self._pending if op[3] is not None]
+
+        # Do the costly part of the pending writes without holding the lock,
+        # then apply them a slice at a time, so that the other threads don't
+        # wait for the whole flush
+        for func in prepare:
+            func()
+        more = True
+        while more:
+            with self.lock:
+                if self.db is None:
+                    return
+                more = self.apply_pending(max_time=CacheStore.lock_slice)
+            if more:
+                # Let a waiting thread take the lock
+                time.sleep(0)
+
+        self._enforce_budget()
+        with self.lock:
+            if self.db is not None:
+                log.debug("Sync %s", self.fn)
+                self.db.commit()
+        cache_stats.record("sync_time", (time.perf_counter() - start) * 1000000)
+
+    def update(self, nbytes=0):
+        flush_scheduler.mark_dirty(self, nbytes)
+
+    # {{{ Maintenance
+    def check(self, thorough=False):
+        """Check the consistency of the database and repair it. The quick
+        check makes sure that the full-text index matches the items; the
+        thorough one also removes the items that can not be decoded anymore.
+
+        Return a list of (channel, items, repaired items, seconds) tuples."""
+        report = []
+        with self.lock:
+            self.apply_pending()
+            check_index = False
+            if self._fts:
+                self._remove_orphans()
+
+                # Only look for the missing entries channel by channel if
+                # there are some
+                nb_indexed = self.db.execute("SELECT COUNT(*) FROM items_fts").fetchone()[0]
+                nb_indexable = self.db.execute("SELECT COUNT(*) FROM items WHERE NOT tombstone").fetchone()[0]
+                check_index = nb_indexed != nb_indexable
+
+            counts = self.db.execute("SELECT channel, COUNT(*) FROM items GROUP BY channel").fetchall()
+            for (jid, nb_items) in counts:
+                start = time.monotonic()
+                repaired = 0
+                if thorough:
+                    repaired += self._check_entries(jid)
+                if check_index:
+                    repaired += self._check_index(jid)
+                duration = time.monotonic() - start
+                if repaired > 0:
+                    log.warning("Repaired %d of the %d items of %s in %.3f seconds", repaired, nb_items, jid, duration)
+                else:
+                    log.debug("Checked %d items of %s in %.3f seconds", nb_items, jid, duration)
+                report.append((jid, nb_items, repaired, duration))
+
+            if any(r[2] > 0 for r in report):
+                if self._fts:
+                    # Broken entries may have been deleted without being
+                    # removed from the full-text index
+                    self._remove_orphans()
+                self.invalidate()
+            self.db.commit()
+        return report
+
+    def _remove_orphans(self):
+        # Remove the entries of items that don't exist anymore from the
+        # full-text index
+        nb = self.db.execute("SELECT COUNT(*) FROM items_fts WHERE rowid NOT IN (SELECT rowid FROM items)").fetchone()[0]
+        if nb == 0:
+            return
+        if self._fts_delete:
+            self.db.execute("DELETE FROM items_fts WHERE rowid NOT IN (SELECT rowid FROM items)")
+        else:
+            # Their text is lost, so they can't be removed one by one
+            self._create_fts()
+        log.warning("Removed %d orphan entries from the full-text index of %s", nb, self.fn)
+
+    def _check_entries(self, jid):
+        rows = self.db.execute("SELECT rowid, entry FROM items WHERE channel=?", (jid,)).fetchall()
+        broken = [rowid for (rowid, data) in rows if self._decode_entry(rowid, data) is None]
+        self._delete_broken(broken)
+        return len(broken)
+
+    def _check_index(self, jid):
+        rows = self.db.execute("SELECT rowid, entry FROM items WHERE channel=? AND NOT tombstone AND NOT EXISTS "
+                               "(SELECT 1 FROM items_fts WHERE items_fts.rowid = items.rowid)", (jid,)).fetchall()
+        broken = []
+        for (rowid, data) in rows:
+            atom = self._decode_entry(rowid, data)
+            if atom is None:
+                broken.append(rowid)
+            else:
+                self.index_item(rowid, atom)
+        self._delete_broken(broken)
+        return len(rows)
+
+    def _decode_entry(self, rowid, data):
+        try:
+            return Atom(ET.fromstring(_decompress_entry(data)))
+        except Exception:
+            log.warning("Broken entry %d in %s", rowid, self.fn, exc_info=True)
+
+    def _delete_broken(self, rowids):
+        self.unindex_items(rowids)
+        self.db.executemany("DELETE FROM items WHERE rowid=?", [(rowid,) for rowid in rowids])
+
+    def invalidate(self):
+        """Forget the channels summary and the totals, so that they are read
+        again from the database. Call it after changing the database behind
+        the Cache instances back."""
+        with self.lock:
+            # The summary is read again without applying the pending writes
+            self.apply_pending()
+            self._summary = None
+            self._totals = None
+
+    def free_space(self):
+        """Return the size of the database and the size of its free space,
+        in bytes."""
+        with self.lock:
+            page_size = self.db.execute("PRAGMA page_size").fetchone()[0]
+            page_count = self.db.execute("PRAGMA page_count").fetchone()[0]
+            freelist_count = self.db.execute("PRAGMA freelist_count").fetchone()[0]
+            return (page_count * page_size, freelist_count * page_size)
+
+    def compact(self):
+        """Rebuild the database file to reclaim its free space, and merge the
+        full-text index segments. Return the sizes before and after."""
+        with self.lock:
+            start = time.monotonic()
+            self.apply_pending()
+            self._enforce_budget()
+            self.db.commit()
+            size_before, _ = self.free_space()
+            if self._fts:
+                self.db.execute("INSERT INTO items_fts (items_fts) VALUES ('optimize')")
+                self.db.commit()
+            self.db.execute("VACUUM")
+            self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            size_after, _ = self.free_space()
+            log.info("Compacted %s from %d to %d bytes in %.3f seconds",
+                     self.fn, size_before, size_after, time.monotonic() - start)
+            return (size_before, size_after)
+
+    def idle(self):
+        """Called by the flush thread when the cache has not been changed for
+        a while."""
+        with self.lock:
+            if self.db is None:
+                return
+            self.checkpoint()
+            size, free = self.free_space()
+        if free >= CacheStore.compact_min_bytes and free >= size * CacheStore.compact_ratio:
+            log.info("%d of the %d bytes of %s are free space: run bccc --check-cache to compact it",
+                     free, size, self.fn)
+
+    def checkpoint(self):
+        """Fold the write-ahead log into the database file and empty it, so
+        that there is nothing to replay when the database is next opened."""
+        with self.lock:
+            start = time.monotonic()
+            self.apply_pending()
+            self.db.commit()
+            busy, frames, _ = self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+            log.debug("Checkpointed %d pages of %s in %.3f seconds%s", frames, self.fn,
+                      time.monotonic() - start, " (busy)" if busy else "")
+    # }}}
+
+    def summary(self, jid):
+        """Return the summary of a channel: a dictionary with its "config",
+        "status", "last_update" and "last_access" (as timestamps)."""
+        with self.lock:
+            if self._summary is None:
+                self._load_summary()
+            summary = self._summary.get(jid)
+            if summary is None:
+                summary = {"config": None, "status": None, "last_update": None, "last_access": None}
+                self._summary[jid] = summary
+            return summary
+
+    def preload(self):
+        """Load the summary of all the channels and list the account cache
+        directory now, instead of on first use."""
+        with self.lock:
+            if self._summary is None:
+                self._load_summary()
+            self.list_files()
+
+    def list_files(self):
+        with self.lock:
+            if self._files is None:
+                self._files = set(os.listdir(self.dir))
+            return self._files
+
+    def forget_summary(self, jid):
+        with self.lock:
+            if self._summary is not None:
+                self._summary.pop(jid, None)
+
+    def _load_summary(self):
+        # The pending writes are not applied first: the summary is loaded
+        # before anything is queued, and invalidate() applies them before
+        # dropping it
+        start = time.monotonic()
+        self._summary = {}
+        for (jid, config, status, last_access) in self.db.execute("SELECT jid, config, status, last_access FROM channels"):
+            self._summary[jid] = {"config": config, "status": status, "last_update": None,
+                                  "last_access": last_access}
+        for (jid, ts) in self.db.execute("SELECT channel, MAX(updated) FROM items GROUP BY channel"):
+            self.summary(jid)["last_update"] = ts
+        log.debug("Loaded summary of %d channels in %.3f seconds", len(self._summary), time.monotonic() - start)
+
+    def index_used(self, cache):
+        """Mark the index of a Cache as recently used, and unload the least
+        recently used ones if there are too many of them."""
+        with self.lock:
+            self._loaded[cache] = True
+            self._loaded.move_to_end(cache)
+            while len(self._loaded) > CacheStore.max_loaded_indexes:
+                old_cache, _ = self._loaded.popitem(last=False)
+                old_cache._unload_index()
+
+    def index_unused(self, cache):
+        with self.lock:
+            self._loaded.pop(cache, None)
+
+    def account(self, nb_items, nb_bytes):
+        """Record a change in the number of items and in the size of their
+        entries."""
+        with self.lock:
+            if self._totals is not None:
+                self._totals[0] += nb_items
+                self._totals[1] += nb_bytes
+
+    def _enforce_budget(self):
+        # Items are evicted a slice at a time, releasing the lock in between
+        with self.lock:
+            if self._totals is None:
+                self._totals = list(self.db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM items").fetchone())
+            nb_items, nb_bytes = self._totals
+            if nb_items <= CacheStore.max_items and nb_bytes <= CacheStore.max_bytes:
+                return
+
+            start = time.monotonic()
+            target_items = int(CacheStore.max_items * CacheStore.evict_ratio)
+            target_bytes = int(CacheStore.max_bytes * CacheStore.evict_ratio)
+
+            # Items are evicted by increasing "score": their date plus the last
+            # time their channel was displayed. So an item of a channel read a
+            # week ago is evicted like an item one week older in a channel read
+            # right now, and channels that are never read go first.
+            rows = self.db.execute("""
+                SELECT rowid, channel, id, size FROM (
+                    SELECT i.rowid AS rowid, i.channel AS channel, i.id AS id, i.size AS size,
+                           i.updated + COALESCE(c.last_access, 0) AS score,
+                           ROW_NUMBER() OVER (PARTITION BY i.channel ORDER BY i.updated DESC) AS rank
+                    FROM items i LEFT JOIN channels c ON c.jid = i.channel)
+                WHERE rank > ? ORDER BY score
+            """, (max(1, CacheStore.min_channel_items),)).fetchall()
+
+        rows = collections.deque(rows)
+        nb_evicted, channels = 0, set()
+        while len(rows) > 0:
+            with self.lock:
+                if self.db is None or self._totals is None:
+                    break
+                deadline = time.perf_counter() + CacheStore.lock_slice
+                evicted = collections.defaultdict(list)
+                while len(rows) > 0 and time.perf_counter() < deadline:
+                    nb_items, nb_bytes = self._totals
+                    if nb_items <= target_items and nb_bytes <= target_bytes:
+                        rows.clear()
+                        break
+                    (rowid, channel, id, size) = rows.popleft()
+                    # Skip the items replaced or deleted since the query
+                    if self.db.execute("SELECT 1 FROM items WHERE rowid=? AND id=?", (rowid, id)).fetchone() is None:
+                        continue
+                    self.unindex_items([rowid])
+                    self.db.execute("DELETE FROM items WHERE rowid=?", (rowid,))
+                    self.account(-1, -size)
+                    evicted[channel].append(id)
+
+                # Keep the loaded indexes consistent. The most recent item of
+                # each channel is never evicted, so the summaries are still
+                # valid.
+                for cache in list(self._loaded):
+                    if cache._jid in evicted:
+                        cache._index_evicted(evicted[cache._jid])
+                nb_evicted += sum(len(ids) for ids in evicted.values())
+                channels.update(evicted)
+            time.sleep(0)
+        cache_stats.incr("items_evicted", nb_evicted)
+
+        totals = self._totals or ("?", "?")
+        log.info("Evicted %d items from %d channels in %s in %.3f seconds (%s items, %s bytes left)",
+                 nb_evicted, len(channels), self.fn, time.monotonic() - start, totals[0], totals[1])
+
+    # {{{ Full-text search
+    _SEARCH_WORD_RE = re.compile(r"\w+")
+
+    def index_item(self, rowid, atom):
+        """Add an item to the full-text index."""
+        if self._fts and not atom.tombstone:
+            self.db.execute("INSERT INTO items_fts (rowid, author, content) VALUES (?, ?, ?)",
+                            (rowid, atom.author or "", atom.content or ""))
+
+    def unindex_items(self, rowids):
+        """Remove some items from the full-text index. This must be done
+        before deleting them from the items table."""
+        if not self._fts:
+            return
+        if self._fts_delete:
+            self.db.executemany("DELETE FROM items_fts WHERE rowid=?", [(rowid,) for rowid in rowids])
+            return
+
+        # Older SQLite: the index must be given the text it indexed
+        for rowid in rowids:
+            if self.db.execute("SELECT 1 FROM items_fts WHERE rowid=?", (rowid,)).fetchone() is None:
+                continue
+            data = self.db.execute("SELECT entry FROM items WHERE rowid=?", (rowid,)).fetchone()
+            try:
+                atom = Atom(ET.fromstring(_decompress_entry(data[0])))
+            except Exception:
+                # Broken entry: check() removes the orphans
+                continue
+            self.db.execute("INSERT INTO items_fts (items_fts, rowid, author, content) VALUES ('delete', ?, ?, ?)",
+                            (rowid, atom.author or "", atom.content or ""))
+
+    def search(self, query, limit=50):
+        """Search the content and author of the cached items of all the
+        channels. All the words of the query must match, the last one being a
+        prefix. Return a list of (channel, id) tuples, best match first."""
+        words = CacheStore._SEARCH_WORD_RE.findall(query)
+        if not self._fts or len(words) == 0:
+            return []
+        match = " ".join('"{}"'.format(w) for w in words) + "*"
+
+        with self.lock:
+            start = time.monotonic()
+            self.apply_pending()
+            hits = self.db.execute("SELECT items.channel, items.id FROM items_fts "
+                                   "JOIN items ON items.rowid = items_fts.rowid "
+                                   "WHERE items_fts MATCH ? ORDER BY rank, items.updated DESC LIMIT ?",
+                                   (match, limit)).fetchall()
+            log.debug("Search for %r: %d hits in %.3f seconds", query, len(hits), time.monotonic() - start)
+            return hits
+    # }}}
+
+    def enqueue(self, jid, nbytes, func, *args, prepare=None):
+        """Queue a write operation on a channel, to be applied later by the
+        flush thread. If given, prepare() is called by the flush thread
+        before applying it, without holding the store lock: it can do the
+        costly work that doesn't need the database (and must be safe to run
+        several times)."""
+        with self.lock:
+            self._pending.append((jid, func, args, prepare))
+        self.update(nbytes)
+
+    def pending(self, jid):
+        """Return the queued write operations of a channel, as (function,
+        args) tuples."""
+        with self.lock:
+            return [(op[1], op[2]) for op in self._pending if op[0] == jid]
+
+    def apply_pending(self, jid=None, max_time=None):
+        """Apply the queued write operations, or only those of a channel.
+        This must be done before reading data from the database that may
+        have been changed since. The operations of different channels are
+        independent, so they can be applied in any order.
+
+        If max_time is given, stop after about that many seconds. Return True
+        if some operations were left for later."""
+        with self.lock:
+            if jid is None:
+                ops, self._pending = self._pending, collections.deque()
+            else:
+                ops = collections.deque(op for op in self._pending if op[0] == jid)
+                if len(ops) == 0:
+                    return False
+                self._pending = collections.deque(op for op in self._pending if op[0] != jid)
+            if len(ops) > 0:
+                log.debug("Applying %d pending operations to %s", len(ops), self.fn)
+            deadline = None
+            if max_time is not None:
+                deadline = time.perf_counter() + max_time
+            while len(ops) > 0:
+                if deadline is not None and time.perf_counter() >= deadline:
+                    self._pending.extendleft(reversed(ops))
+                    return True
+                op = ops.popleft()
+                try:
+                    op[1](*op[2])
+                except sqlite3.OperationalError:
+                    # E.g. locked database: keep everything for next time
+                    ops.appendleft(op)
+                    self._pending.extendleft(reversed(ops))
+                    raise
+                except Exception:
+                    # Broken operation: drop it, but keep the next ones
+                    self._pending.extendleft(reversed(ops))
+                    raise
+            return False
+# }}}
+# {{{ Channel cache
 class Cache:
     """Cache a channel and its content"""
 
     # {{{ Constructor and parameters
     cache_dir = os.path.join(os.getenv("XDG_CACHE_HOME", os.path.expanduser("~")), "bccc")
-    max_items = 200
     never = datetime.datetime.fromtimestamp(0, tz=dateutil.tz.tzlocal())
 
     def __init__(self, account_jid, channel_jid):
         self._jid = channel_jid
 
+        account_cache_dir = Cache._account_dir(account_jid)
+        self._store = CacheStore.open(account_cache_dir)
+        self._lock = self._store.lock
+        self._closed = False
+
+        # In-memory index of the cached items, loaded on first use:
+        # - _dates: sorted list of (timestamp, id) tuples, oldest first
+        # - _ids: id -> [timestamp, hash of the entry or None if not known yet]
+        self._dates = None
+        self._ids = None
+
+        # Import the old shelve-based cache, if any
+        self._migrate_shelve(os.path.join(account_cache_dir, self._jid))
+
+    def __del__(self):
+        if not getattr(self, "_closed", True):
+            self.close()
+
+    @staticmethod
+    def check_account(account_jid):
+        """Thoroughly check and repair the cache of an account, then compact
+        it. Return the report of CacheStore.check() and the sizes of the
+        database before and after compaction."""
+        store = CacheStore.open(Cache._account_dir(account_jid))
+        try:
+            return (store.check(thorough=True), store.compact())
+        finally:
+            store.release()
+
+    # {{{ Export and import
+    # The export format is made of JSON objects, one per line: a header with
+    # the format version, then for each channel a "channel" record followed
+    # by its "item" records. Entries are exported as plain XML, so that they
+    # don't depend on the on-disk format.
+    export_format = "bccc-cache"
+    export_version = 1
+    import_chunk_size = 1000
+
+    @staticmethod
+    def _json_default(obj):
+        if isinstance(obj, datetime.datetime):
+            return {"$datetime": obj.isoformat()}
+        raise TypeError("Can't export {!r}".format(obj))
+
+    @staticmethod
+    def _json_hook(obj):
+        if "$datetime" in obj:
+            return datetime.datetime.fromisoformat(obj["$datetime"])
+        return obj
+
+    @staticmethod
+    def export_account(account_jid, f):
+        """Export the cache of an account to a text file object, one record at
+        a time. Return the number of channels and items exported."""
+        store = CacheStore.open(Cache._account_dir(account_jid))
+        dump = lambda obj: f.write(json.dumps(obj, default=Cache._json_default) + "\n")
+        nb_channels, nb_items = 0, 0
+        try:
+            with store.lock:
+                store.apply_pending()
+                dump({"format": Cache.export_format, "version": Cache.export_version, "account": account_jid})
+
+                # Channels with no items first, then each channel followed by
+                # its items, oldest first
+                channels = {jid: (config, status, last_access) for (jid, config, status, last_access)
+                            in store.db.execute("SELECT jid, config, status, last_access FROM channels")}
+                def dump_channel(jid):
+                    config, status, last_access = channels.pop(jid, (None, None, None))
+                    dump({"type": "channel", "jid": jid, "status": status, "last_access": last_access,
+                          "config": pickle.loads(config) if config is not None else None})
+
+                current = None
+                for (jid, id, data) in store.db.execute("SELECT channel, id, entry FROM items ORDER BY channel, updated"):
+                    if jid != current:
+                        dump_channel(jid)
+                        current = jid
+                        nb_channels += 1
+                    dump({"type": "item", "id": id, "entry": _decompress_entry(data)})
+                    nb_items += 1
+                for jid in list(channels):
+                    dump_channel(jid)
+                    nb_channels += 1
+        finally:
+            store.release()
+        log.info("Exported %d channels and %d items from the cache of %s", nb_channels, nb_items, account_jid)
+        return (nb_channels, nb_items)
+
+    @staticmethod
+    def import_account(account_jid, f):
+        """Import records written by export_account() from a text file object
+        into the cache of an account, replacing the existing items with the
+        same ids. Return the number of channels and items imported."""
+        header = json.loads(f.readline() or "{}")
+        if header.get("format") != Cache.export_format:
+            raise ValueError("Not a bccc cache export")
+        if header.get("version") != Cache.export_version:
+            raise ValueError("Unsupported cache export version {}".format(header.get("version")))
+
+        # Keep the store open while switching from channel to channel
+        store = CacheStore.open(Cache._account_dir(account_jid))
+        cache = None
+        nb_channels, nb_items = 0, 0
+        try:
+            for (lineno, line) in enumerate(f, 2):
+                rec = json.loads(line, object_hook=Cache._json_hook)
+                if rec.get("type") == "channel":
+                    if cache is not None:
+                        cache.close()
+                    cache = Cache(account_jid, rec["jid"])
+                    with cache._lock:
+                        if rec["config"] is not None:
+                            cache._write_channel_field("config", pickle.dumps(rec["config"]))
+                        for field in ("status", "last_access"):
+                            if rec[field] is not None:
+                                cache._write_channel_field(field, rec[field])
+                    nb_channels += 1
+                elif rec.get("type") == "item" and cache is not None:
+                    atom = Atom(ET.fromstring(rec["entry"]))
+                    with cache._lock:
+                        cache._write_entry(rec["id"], (Cache._atom_date(atom), rec["entry"]), atom)
+                    nb_items += 1
+                    if nb_items % Cache.import_chunk_size == 0:
+                        cache.sync()
+                else:
+                    log.warning("Skipping unexpected record on line %d", lineno)
+        finally:
+            if cache is not None:
+                cache.close()
+            store.invalidate()
+            store.release()
+        log.info("Imported %d channels and %d items into the cache of %s", nb_channels, nb_items, account_jid)
+        return (nb_channels, nb_items)
+    # }}}
+
+    @staticmethod
+    def _account_dir(account_jid):
         account_cache_dir = os.path.join(Cache.cache_dir, account_jid)
         if not os.path.isdir(account_cache_dir):
             os.makedirs(account_cache_dir)
-        self._fn = os.path.join(account_cache_dir, self._jid)
-        self._db = shelve.open(self._fn)
-
-        self._lock = threading.RLock()
-        self._timer = None
+        return account_cache_dir
 
-    def __del__(self):
-        with self._lock:
-            if self._db is not None:
-                self.close()
+    @property
+    def _db(self):
+        # Queued writes may still be applied after this Cache was closed, so
+        # always go through the store
+        return self._store.db
     # }}}
     # {{{ Sync handling
     def delete(self):
         with self._lock:
+            self._store.apply_pending(self._jid)
+            nb_items, nb_bytes = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM items WHERE channel=?",
+                                                  (self._jid,)).fetchone()
+            rowids = [r[0] for r in self._db.execute("SELECT rowid FROM items WHERE channel=?", (self._jid,))]
+            self._store.unindex_items(rowids)
+            self._db.execute("DELETE FROM items WHERE channel=?", (self._jid,))
+            self._store.account(-nb_items, -nb_bytes)
+            self._db.execute("DELETE FROM channels WHERE jid=?", (self._jid,))
+            self._store.forget_summary(self._jid)
+            self._store.update()
+            self._unload_index()
             self.close()
-            os.remove(self._fn)
 
     def close(self):
         with self._lock:
-            self._update()
-            if self._timer is not None:
-                self._timer.cancel()
-                self._timer = None
-            self._db.close()
-            self._db = None
+            if self._closed:
+                return
+            self._closed = True
+            self._unload_index()
+        self._store.release()
 
     def sync(self, *args):
-        with self._lock:
-            log.debug("Sync %s", self._jid)
-            self._db.sync()
-            self._timer = None
+        self._store.sync()
+    # }}}
+    # {{{ Migration from shelve
+    def _migrate_shelve(self, fn):
+        # Depending on the dbm backend, shelve may have created several files
+        candidates = [fn + ext for ext in ("", ".db", ".dat", ".dir", ".bak", ".pag")]
+        files = self._store.list_files()
+        if not any(os.path.basename(f) in files for f in candidates) or not dbm.whichdb(fn):
+            return
 
-    def _update(self):
+        log.info("Migrating cache of %s from %s to SQLite", self._jid, fn)
         with self._lock:
-            if self._timer is not None:
-                self._timer.cancel()
-            self._timer = threading.Timer(random.uniform(3, 8), self.sync)
-            self._timer.start()
+            try:
+                with shelve.open(fn, flag="r") as old_db:
+                    if "config" in old_db:
+                        self.config = old_db["config"]
+                    if "status" in old_db:
+                        self.status = old_db["status"]
+                    for id in old_db.get("items", []):
+                        key = "item-" + id
+                        if key not in old_db:
+                            log.warning("Dangling item %s in %s", id, fn)
+                            continue
+                        upd, xml = old_db[key]
+                        if upd.tzinfo is None:
+                            upd = upd.replace(tzinfo=datetime.timezone.utc)
+                        ts = (upd - Cache.never) // datetime.timedelta(microseconds=1)
+                        self._write_entry(id, (ts, xml), Atom(ET.fromstring(xml)))
+                        summary = self._store.summary(self._jid)
+                        if summary["last_update"] is None or summary["last_update"] < ts:
+                            summary["last_update"] = ts
+                self._store.sync()
+            except Exception:
+                log.exception("Could not migrate cache of %s", self._jid)
+                self._db.rollback()
+                self._store.forget_summary(self._jid)
+                return
+
+        for f in candidates:
+            if os.path.isfile(f):
+                os.remove(f)
+            files.discard(os.path.basename(f))
     # }}}
     # {{{ Data conversion
+    @staticmethod
+    def _atom_date(atom):
+        upd = atom.updated_ts
+        if upd is None:
+            upd = atom.published_ts
+        if upd is None:
+            upd = 0
+        return upd
+
     @staticmethod
     def _atom_to_entry(atom):
-        upd = Cache.never
-        try:
-            upd = atom.updated
-        except AttributeError:
-            upd = atom.published
-        xml = ET.tostring(atom.elt, encoding="unicode")
-        return (upd, xml)
+        if atom.xml is None:
+            raise AtomError("Can't cache Atom {}: its entry was not kept".format(atom.id))
+        return (Cache._atom_date(atom), atom.xml)
 
     @staticmethod
-    def _entry_to_atom(entry):
-        xml = entry[1]
-        elt = ET.fromstring(xml)
-        return Atom(elt)
+    def _atom_digest(atom):
+        # Used to tell if an item has changed, without serializing it
+        return hash((atom.updated_ts, atom.published_ts, atom.tombstone, atom.author,
+                     atom.in_reply_to, atom.object_type, atom.content))
+
+    @staticmethod
+    def _atom_headers(atom):
+        return (atom.published_ts, atom.author, atom.in_reply_to,
+                atom.object_type, int(atom.tombstone))
+
+    @staticmethod
+    def _ts_to_date(ts):
+        return Cache.never + datetime.timedelta(microseconds=ts)
+
+    @staticmethod
+    def _now_ts():
+        return int(time.time() * 1000000)
     # }}}
     # {{{ Simple cached properties
+    def _set_channel_field(self, field, value, nbytes=0):
+        self._store.summary(self._jid)[field] = value
+        self._store.enqueue(self._jid, nbytes, self._write_channel_field, field, value)
+
+    def _write_channel_field(self, field, value):
+        self._db.execute("INSERT OR IGNORE INTO channels (jid) VALUES (?)", (self._jid,))
+        self._db.execute("UPDATE channels SET {}=? WHERE jid=?".format(field),
+                         (value, self._jid))
+
     @property
     def config(self):
         with self._lock:
-            if "config" in self._db:
-                return self._db["config"]
+            conf = self._store.summary(self._jid)["config"]
+            if conf is not None:
+                return pickle.loads(conf)
             else:
                 return {}
     @config.setter
     def config(self, conf):
         with self._lock:
-            if "config" not in self._db or self._db["config"] != conf:
-                self._db["config"] = conf
-                self._update()
+            if self.config != conf:
+                conf = pickle.dumps(conf)
+                self._set_channel_field("config", conf, len(conf))
 
     @property
     def status(self):
         with self._lock:
-            if "status" in self._db:
-                return self._db["status"]
+            return self._store.summary(self._jid)["status"]
     @status.setter
     def status(self, val):
         with self._lock:
-            if "status" not in self._db or self._db["status"] != val:
-                self._db["status"] = val
-                self._update()
+            if self.status != val:
+                self._set_channel_field("status", val, len(val) if val is not None else 0)
     # }}}
     # {{{ Items handling
     @property
     def items(self):
+        """The cached items, newest first. Only their header fields are read
+        now; their content is loaded when first needed.
+
+        This counts as an access to the channel, which protects its items from
+        eviction."""
         with self._lock:
-            if "items" not in self._db:
-                return []
-            else:
-                entries = [self._db["item-"+id] for id in self._db["items"]]
-                atoms = [Cache._entry_to_atom(entry) for entry in entries]
-                return atoms
+            self._set_channel_field("last_access", Cache._now_ts())
+            self._store.apply_pending(self._jid)
+            rows = self._db.execute("SELECT id, updated, published, author, in_reply_to, object_type, tombstone "
+                                    "FROM items WHERE channel=? ORDER BY updated DESC, rowid DESC",
+                                    (self._jid,)).fetchall()
+        cache_stats.incr("items_listed", len(rows))
+        return CachedItems(self, rows)
+
+    def search(self, query, limit=50):
+        """Search the cached items of all the channels of the account. Return
+        a list of (channel, id) tuples, best match first."""
+        return self._store.search(query, limit)
+
+    def _read_entries(self, ids):
+        """Read and parse the cached entries with the given ids. Return a
+        {id: Atom} dictionary.
+
+        Pending writes are not applied first: this is used to read items that
+        are known to be in the database, and must not make the UI thread
+        write the items queued since."""
+        start = time.perf_counter()
+        with self._lock:
+            marks = ",".join("?" * len(ids))
+            rows = self._db.execute("SELECT id, entry FROM items WHERE channel=? AND id IN ({})".format(marks),
+                                    [self._jid] + list(ids)).fetchall()
+
+        # Feed all the entries to a single streaming parser, wrapped in a
+        # dummy root element
+        parser = AtomStreamParser()
+        parser.feed("<entries>")
+        atoms = {}
+        for (id, data) in rows:
+            for atom in parser.feed(_decompress_entry(data)):
+                atoms[id] = atom
+        cache_stats.incr("entries_read", len(rows))
+        cache_stats.incr("entries_parsed", len(atoms))
+        cache_stats.record("read_time", (time.perf_counter() - start) * 1000000)
+        return atoms
+
+    @staticmethod
+    def _compress_items(atoms, compressed):
+        # Called from the flush thread, without holding the store lock
+        for atom in atoms:
+            if atom.id not in compressed:
+                compressed[atom.id] = _compress_entry(Cache._atom_to_entry(atom)[1])
+
+    def _write_items(self, atoms, compressed):
+        # Called from the flush thread
+        for atom in atoms:
+            self._write_entry(atom.id, Cache._atom_to_entry(atom), atom, compressed.get(atom.id))
+
+    def _write_entry(self, id, entry, atom, data=None):
+        if data is None:
+            data = _compress_entry(entry[1])
+        size = len(data)
+        cache_stats.incr("bytes_written", size)
+        cache_stats.incr("xml_bytes_written", len(entry[1]))
+        cache_stats.record("entry_size", size)
+        old = self._db.execute("SELECT rowid, size FROM items WHERE channel=? AND id=?", (self._jid, id)).fetchone()
+        if old is not None:
+            self._store.unindex_items([old[0]])
+        cur = self._db.execute("INSERT OR REPLACE INTO items (channel, id, updated, entry, size, published, author, in_reply_to, object_type, tombstone) "
+                               "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                               (self._jid, id, entry[0], data, size) + Cache._atom_headers(atom))
+        self._store.index_item(cur.lastrowid, atom)
+        if old is None:
+            self._store.account(1, size)
+        else:
+            self._store.account(0, size - old[1])
+
+    def _delete_item(self, id):
+        # Called from the flush thread
+        old = self._db.execute("SELECT rowid, size FROM items WHERE channel=? AND id=?", (self._jid, id)).fetchone()
+        if old is not None:
+            self._store.unindex_items([old[0]])
+            self._db.execute("DELETE FROM items WHERE rowid=?", (old[0],))
+            self._store.account(-1, -old[1])
+
+    def _load_index(self):
+        if self._dates is not None:
+            cache_stats.incr("index_hits")
+        else:
+            cache_stats.incr("index_misses")
+            rows = self._db.execute("SELECT updated, id FROM items WHERE channel=?",
+                                    (self._jid,)).fetchall()
+            self._ids = {id: [ts, None] for (ts, id) in rows}
+
+            # The queued writes are not in the database yet: apply them to
+            # the index only, rather than writing them from this thread
+            for (func, args) in self._store.pending(self._jid):
+                if func.__func__ is Cache._write_items:
+                    for atom in args[0]:
+                        self._ids[atom.id] = [Cache._atom_date(atom), Cache._atom_digest(atom)]
+                elif func.__func__ is Cache._delete_item:
+                    self._ids.pop(args[0], None)
+            self._dates = sorted((ts, id) for (id, (ts, _)) in self._ids.items())
+        self._store.index_used(self)
+
+    def _unload_index(self):
+        self._dates, self._ids = None, None
+        self._store.index_unused(self)
+
+    def _update_summary(self):
+        last_update = None
+        if len(self._dates) > 0:
+            last_update = self._dates[-1][0]
+        self._store.summary(self._jid)["last_update"] = last_update
+
+    def _index_remove(self, id):
+        ts = self._ids.pop(id)[0]
+        pos = bisect.bisect_left(self._dates, (ts, id))
+        del self._dates[pos]
+
+    def _index_evicted(self, ids):
+        # Called by the store when some items were evicted from the database
+        for id in ids:
+            if id in self._ids:
+                self._index_remove(id)
 
     @property
     def last_update(self):
         with self._lock:
-            if "items" in self._db:
-                id = self._db["items"][0]
-                entry = self._db["item-"+id]
-                return entry[0]
+            ts = self._store.summary(self._jid)["last_update"]
+            if ts is not None:
+                return Cache._ts_to_date(ts)
             else:
                 return Cache.never
 
     def add_item(self, atom):
         # Returns True if this atom is new (i.e. wasn't cached).
+        return len(self.add_items([atom])) > 0
+
+    def add_items(self, atoms):
+        """Add several items at once. Return the list of the atoms that are
+        new (i.e. weren't cached), in the order they were given.
+
+        This only updates the in-memory index: the database is written to
+        later by the flush thread."""
         with self._lock:
-            aid = atom.id
-            entry = Cache._atom_to_entry(atom)
-
-            if "items" not in self._db or len(self._db["items"]) == 0:
-                self._db["items"] = [aid]
-                self._db["item-"+aid] = entry
-                self._update()
-                return True
-
-            ids = self._db["items"]
-            # Is the item already in cache?
-            if aid in ids:
-                # Is it really the same item? (Maybe we're replacing a post by a tombstone)
-                cached_entry = self._db["item-"+aid]
-                if cached_entry == entry:
-                    return False
-                else:
-                    ids.remove(aid)
+            self._load_index()
 
-            # Is the item too old to be in cache?
-            if len(ids) >= Cache.max_items:
-                oldest_entry = self._db["item-"+ids[-1]]
-                if oldest_entry[0] > entry[0]:
-                    return True
+            # If an item is in the batch several times, its last version wins
+            batch = {}
+            for atom in atoms:
+                batch[atom.id] = atom
+            digests = {aid: Cache._atom_digest(atom) for (aid, atom) in batch.items()}
 
-            # Insert new entry, preserving the order (newest items first)
-            lo, hi = 0, len(ids)
-            while lo < hi:
-                mid = (lo+hi) // 2
-                mid_entry = self._db["item-"+ids[mid]]
-                if entry[0] >= mid_entry[0]: hi = mid
-                else: lo = mid+1
-
-            # Only insert if recent enough
-            if lo < Cache.max_items:
-                ids.insert(lo, aid)
-                self._db["item-"+aid] = entry
-
-                # Clean oldest items
-                while len(ids) > Cache.max_items:
-                    id = ids.pop()
-                    del self._db["item-"+id]
-                    changed = True
-
-                self._db["items"] = ids
-                self._update()
-            return True
+            # Read the cached versions we don't know the digest of in one go
+            unknown = [aid for aid in batch if aid in self._ids and self._ids[aid][1] is None]
+            if len(unknown) > 0:
+                for (aid, cached_atom) in self._read_entries(unknown).items():
+                    self._ids[aid][1] = Cache._atom_digest(cached_atom)
+
+            new_atoms = []
+            nb_updated = 0
+            for (aid, atom) in batch.items():
+                # Is the item already in cache? Is it really the same item?
+                # (Maybe we're replacing a post by a tombstone)
+                if aid in self._ids:
+                    if self._ids[aid][1] == digests[aid]:
+                        continue
+                    self._index_remove(aid)
+                    nb_updated += 1
+                new_atoms.append(atom)
+            cache_stats.incr("add_new", len(new_atoms) - nb_updated)
+            cache_stats.incr("add_updated", nb_updated)
+            cache_stats.incr("add_duplicate", len(batch) - len(new_atoms))
+            if len(new_atoms) == 0:
+                return []
+
+            # Merge the sorted batch into the index: sort() only has to merge
+            # two sorted runs. Old items are not dropped here: the store
+            # evicts items when the account-wide budget is exceeded.
+            added = sorted((Cache._atom_date(atom), atom.id) for atom in new_atoms)
+            self._dates.extend(added)
+            self._dates.sort()
+            for (date, aid) in added:
+                self._ids[aid] = [date, digests[aid]]
+
+            # Queue the writes in chunks. Their entries are compressed by the
+            # flush thread before it takes the lock.
+            self._update_summary()
+            size = CacheStore.write_chunk_size
+            for pos in range(0, len(new_atoms), size):
+                chunk, compressed = new_atoms[pos:pos+size], {}
+                self._store.enqueue(self._jid, sum(len(atom.content) for atom in chunk),
+                                    self._write_items, chunk, compressed,
+                                    prepare=functools.partial(Cache._compress_items, chunk, compressed))
+            return new_atoms
 
     def del_item(self, id):
         with self._lock:
-            changed = False
-            full_id = "item-"+id
-
-            if "items" in self._db and id in self._db["items"]:
-                items = self._db["items"]
-                items.remove(id)
-                self._db["items"] = items
-                changed = True
-            if full_id in self._db:
-                del self._db[full_id]
-                changed = True
-            if changed:
-                self._update()
+            self._load_index()
+            if id in self._ids:
+                self._index_remove(id)
+                self._update_summary()
+                self._store.enqueue(self._jid, 0, self._delete_item, id)
     # }}}
+# }}}
+# {{{ Startup warm-up
+class CacheWarmUp(threading.Thread):
+    """Load the cache metadata of all the channels of an account in a
+    background thread, e.g. while waiting for the list of subscriptions.
+
+    The store is kept open until close() is called, so that the Cache
+    instances created in the meantime find everything already loaded."""
+
+    def __init__(self, account_jid):
+        super().__init__(name="cache warm-up")
+        self.daemon = True
+        self.account_jid = account_jid
+        self.store = None
+        self.start()
+
+    def run(self):
+        start = time.monotonic()
+        try:
+            self.store = CacheStore.open(Cache._account_dir(self.account_jid))
+            self.store.preload()
+        except Exception:
+            log.exception("Could not warm up the cache of %s", self.account_jid)
+        log.debug("Cache of %s warmed up in %.3f seconds", self.account_jid, time.monotonic() - start)
+
+    def close(self):
+        self.join()
+        if self.store is not None:
+            self.store.release()
+            self.store = None
+# }}}
+# {{{ Lazily loaded items
+class CachedAtom(Atom):
+    """An Atom read from the cache.
+
+    Its header fields (id, author, dates, in_reply_to, object_type and
+    tombstone) are available right away, but its body is only read from the
+    database and parsed when one of the other fields is needed. Its entry is
+    not kept."""
+
+    __slots__ = ("_items", "_body")
+
+    def __init__(self, items, row):
+        (self.id, self.updated_ts, self.published_ts, self.author,
+         self.in_reply_to, self.object_type, tombstone) = row
+        self.tombstone = bool(tombstone)
+        self.updated = Cache._ts_to_date(self.updated_ts)
+        self.published = None
+        if self.published_ts is not None:
+            self.published = Cache._ts_to_date(self.published_ts)
+        self.xml = None
+        self._items = items
+        self._body = None
+
+    def _get_body(self):
+        if self._body is None:
+            self._items._load_bodies(self)
+        return self._body
+
+    content = property(lambda self: self._get_body().content)
+    link    = property(lambda self: self._get_body().link)
+    verb    = property(lambda self: self._get_body().verb)
+
+class CachedItems:
+    """The cached items of a channel, newest first.
+
+    The bodies of the items are loaded and parsed page by page, when they are
+    first needed."""
+
+    page_size = 50
+
+    def __init__(self, cache, rows):
+        self._cache = cache
+        self._atoms = [CachedAtom(self, row) for row in rows]
+        self._pos = {a.id: idx for (idx, a) in enumerate(self._atoms)}
+
+    def __getitem__(self, idx):
+        return self._atoms[idx]
+    def __iter__(self):
+        return iter(self._atoms)
+    def __len__(self):
+        return len(self._atoms)
+
+    def _load_bodies(self, atom):
+        start = self._pos[atom.id]
+        page = [a for a in self._atoms[start:start+CachedItems.page_size] if a._body is None]
+        bodies = self._cache._read_entries([a.id for a in page])
+        for a in page:
+            body = bodies.get(a.id)
+            if body is None:
+                # Evicted or deleted since the headers were read: its author
+                # and content are lost, so make it a tombstone
+                log.warning("Item %s is not in the cache anymore", a.id)
+                body = Atom(ET.Element(Atom._TAG_TOMBSTONE))
+                a.tombstone = True
+            a._body = body
+# }}}
@@ -11,11 +11,47 @@
 # CONDITIONS OF ANY KIND, either express or implied. See the License for the
 # specific language governing permissions and limitations under the License.
 
+import collections
+
 import dateutil.tz
 import urwid
 
 from .util import BoxedEdit
 
+# {{{ Sub-widgets cache
+class SubWidgetsCache:
+    """Bounded LRU of the item widgets whose sub-widgets are built.
+
+    Item widgets only build their sub-widgets when urwid needs to measure or
+    render them, so that loading a channel with thousands of posts is cheap.
+    The sub-widgets of the least recently used items are dropped when there
+    are more than max_size of them; they will be built again if needed."""
+
+    max_size = 500
+
+    def __init__(self):
+        self._items = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def touch(self, w):
+        key = id(w)
+        if key in self._items:
+            self._items.move_to_end(key)
+            return
+        self._items[key] = w
+        while len(self._items) > SubWidgetsCache.max_size:
+            _, old = self._items.popitem(last=False)
+            old._widgets = None
+
+    def clear(self):
+        for w in self._items.values():
+            w._widgets = None
+        self._items.clear()
+
+subwidgets_cache = SubWidgetsCache()
+# }}}
 # {{{ Basic item widget
 class ItemWidget(urwid.FlowWidget):
     attr_author = ("post author", "focused post author")
@@ -27,22 +63,35 @@ class ItemWidget(urwid.FlowWidget):
         self._author = author
         self._date = date
         self._text = text
+        self._padding = padding
 
-        # Init sub-widgets
-        author_w = urwid.Text((" "*padding) + author, wrap="clip")
-        author_w = urwid.AttrMap(author_w, *self.attr_author)
+        # Sub-widgets are built on demand
+        self._widgets = None
 
-        date_w = urwid.Text(date, align="right", wrap="clip")
-        date_w = urwid.AttrMap(date_w, *self.attr_date)
-
-        text_w = urwid.Text(text)
-        text_w = urwid.Padding(text_w, left=4+padding, right=1)
-        text_w = urwid.AttrMap(text_w, *self.attr_text)
-
-        self.widgets = (author_w, date_w, text_w)
+        # Number of rows, by (maxcol, focus), for the current width
+        self._rows_cache = {}
         urwid.FlowWidget.__init__(self)
         self._selectable = True
 
+    @property
+    def widgets(self):
+        if self._widgets is None:
+            padding = self._padding
+
+            author_w = urwid.Text((" "*padding) + self.author, wrap="clip")
+            author_w = urwid.AttrMap(author_w, *self.attr_author)
+
+            date_w = urwid.Text(self.date, align="right", wrap="clip")
+            date_w = urwid.AttrMap(date_w, *self.attr_date)
+
+            text_w = urwid.Text(self.text)
+            text_w = urwid.Padding(text_w, left=4+padding, right=1)
+            text_w = urwid.AttrMap(text_w, *self.attr_text)
+
+            self._widgets = (author_w, date_w, text_w)
+        subwidgets_cache.touch(self)
+        return self._widgets
+
     @property
     def id(self): return self._id
 
@@ -62,19 +111,30 @@ class ItemWidget(urwid.FlowWidget):
         return key
 
     def rows(self, size, focus=False):
-        return self.widgets[2].rows(size, focus) + 1
+        # Wrapping the text is expensive, and the text never changes, so
+        # cache the result until the width changes.
+        key = (size[0], focus)
+        rows = self._rows_cache.get(key)
+        if rows is None:
+            if any(k[0] != size[0] for k in self._rows_cache):
+                self._rows_cache.clear()
+            rows = self.widgets[2].rows(size, focus) + 1
+            self._rows_cache[key] = rows
+        return rows
 
     def render(self, size, focus=False):
         maxcol = size[0]
 
+        widgets = self.widgets
+
         # Render first line
-        author_col, _ = self.widgets[0].pack(focus=focus)
-        date_col, _ = self.widgets[1].pack(focus=focus)
+        author_col, _ = widgets[0].pack(focus=focus)
+        date_col, _ = widgets[1].pack(focus=focus)
         canvas_head = None
         if author_col + date_col <= maxcol:
             # We can render them both!
-            canvas_author = self.widgets[0].render((maxcol-date_col,), focus)
-            canvas_date = self.widgets[1].render((date_col,), focus)
+            canvas_author = widgets[0].render((maxcol-date_col,), focus)
+            canvas_date = widgets[1].render((date_col,), focus)
             canv = [
                 (canvas_author, None, True, maxcol-date_col),
                 (canvas_date,   None, True, date_col),
@@ -82,10 +142,10 @@ class ItemWidget(urwid.FlowWidget):
             canvas_head = urwid.CanvasJoin(canv)
         else:
             # Only render author
-            canvas_head = self.widgets[0].render(size, focus)
+            canvas_head = widgets[0].render(size, focus)
 
         # Render text
-        canvas_text = self.widgets[2].render(size, focus)
+        canvas_text = widgets[2].render(size, focus)
 
         canv = [
             (canvas_head, None, True),
@@ -101,12 +161,35 @@ class PostWidget(ItemWidget):
 
         author = "[deleted]"
         text = "[deleted]"
-        date = post.published.astimezone(dateutil.tz.tzlocal()).strftime("%x - %X")
         if not post.tombstone:
             author = post.author
-            text = post.content
+            text = None
 
-        ItemWidget.__init__(self, post.id, author, date, text, padding)
+        # The text (which may not be loaded from the cache yet) and the date
+        # are only needed to build the sub-widgets
+        ItemWidget.__init__(self, post.id, author, None, text, padding)
+
+    @property
+    def author(self):
+        # Load the text first: the item may turn out to be a tombstone
+        self.text
+        return self._author
+
+    @property
+    def text(self):
+        if self._text is None:
+            text = self._item.content
+            if self._item.tombstone:
+                # Cached item evicted since it was listed
+                self._author = text = "[deleted]"
+            self._text = text
+        return self._text
+
+    @property
+    def date(self):
+        if self._date is None:
+            self._date = self._item.published.astimezone(dateutil.tz.tzlocal()).strftime("%x - %X")
+        return self._date
 
     @property
     def item(self): return self._item
@@ -127,7 +210,7 @@ class ReplyWidget(PostWidget):
     def in_reply_to(self): return self._in_reply_to
 
     def __lt__(self, other):
-        return self.item.published < other.item.published
+        return self.item.published_ts < other.item.published_ts
 
     def __eq__(self, other):
         return type(other) is ReplyWidget and self.id == other.id
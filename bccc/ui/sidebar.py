@@ -12,12 +12,17 @@
 # specific language governing permissions and limitations under the License.
 
 import datetime
+import logging
 import operator as op
+import time
 
 import urwid
 
 from bccc.client import ChannelError
-from bccc.ui import Cache
+from bccc.ui import Cache, CacheWarmUp
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
 
 # {{{ Channel box
 class ChannelBox(urwid.widget.BoxWidget):
@@ -45,17 +50,17 @@ class ChannelBox(urwid.widget.BoxWidget):
         w = urwid.AttrMap(w, "channel status", "focused channel status")
         self.widget_status = w
 
-        # Set title to JID until we now more
-        self.set_title(channel.jid)
-
         # Channel configuration
         self.chan_title = ""
         self.chan_description = ""
         self.chan_creation = None
         self.chan_type = ""
 
-        # Load data from cache
-        self.set_config(self.cache.config, False)
+        # Load data from cache. Set title to JID until we now more.
+        config = self.cache.config
+        if "title" not in config:
+            self.set_title(channel.jid)
+        self.set_config(config, False)
         status = self.cache.status
         if status is not None:
             self.widget_status.original_widget.set_text(status)
@@ -79,10 +84,7 @@ class ChannelBox(urwid.widget.BoxWidget):
 
     # {{{ PubSub Callbacks
     def pubsub_posts_callback(self, atoms):
-        new_atoms = []
-        for atom in atoms:
-            if self.cache.add_item(atom):
-                new_atoms.append(atom)
+        new_atoms = self.cache.add_items(atoms)
 
         # Find most recent atom
         recent_changed = self.last_update != self.cache.last_update
@@ -279,36 +281,45 @@ class ChannelsList(urwid.ListBox):
             return urwid.ListBox.keypress(self, size, key)
 
     def load_channels(self):
+        start = time.monotonic()
+
+        # Read the cache metadata of all the channels while the subscriptions
+        # are being requested
+        warm_up = CacheWarmUp(self.ui.client.boundjid.bare)
+
         # Request user channel
         user_chan = self.ui.client.get_channel()
 
         # Request user subscriptions
         chans = user_chan.get_subscriptions()
 
-        # First empty the list
-        del self._channels[:]
-
-        # Then add each channel to it
+        # Create all the channel boxes, then populate the list in one go:
+        # user channel, divider, and the others sorted by last update (because
+        # of the cache, they already need to be sorted now)
+        warm_up.join()
+        user_box, boxes = None, []
         for chan in chans:
             w = ChannelBox(self.ui, chan)
             if chan.jid == self.ui.client.boundjid.bare:
-                self._channels.insert(0, w)
-                self.make_active(w)
+                user_box = w
             else:
-                self._channels.append(w)
+                boxes.append(w)
+        warm_up.close()
+        boxes.sort(key=op.attrgetter("last_update"), reverse=True)
+        if user_box is not None:
+            boxes.insert(0, user_box)
+        boxes.insert(1, urwid.Divider("─"))
+        self._channels[:] = boxes
+        if user_box is not None:
+            self.make_active(user_box)
+        log.info("Sidebar populated with %d channels in %.3f seconds", len(chans), time.monotonic() - start)
 
         # Find the oldest mtime and MAM a little earlier
-        mtimes = [chan.cache.last_update for chan in self._channels if chan.cache.last_update > Cache.never]
+        mtimes = [w.cache.last_update for w in boxes if type(w) is ChannelBox and w.cache.last_update > Cache.never]
         if len(mtimes) > 0:
             mtime = min(mtimes) - datetime.timedelta(days=1)
             self.ui.client.mam(start=mtime)
 
-        # A nice divider :)
-        self._channels.insert(1, urwid.Divider("─"))
-
-        # Because of the cache, we already need to sort now.
-        self.sort_channels()
-
         self.ui.refresh()
 
     def sort_channels(self):
@@ -12,23 +12,34 @@
 # specific language governing permissions and limitations under the License.
 
 import bisect
+import itertools
 import logging
+import threading
+import time
 
 import urwid
 
 from bccc.ui import ItemWidget, PostWidget, ReplyWidget, \
                     NewPostWidget, NewReplyWidget, \
                     EditPostWidget, EditReplyWidget
-from .util import extract_urls
+from .item import subwidgets_cache
+from .util import FenwickTree, extract_urls
 
 log = logging.getLogger(__name__)
 log.addHandler(logging.NullHandler())
 
 # {{{ ThreadList helper
 class ThreadList(list):
+    def __init__(self, *args):
+        super().__init__(*args)
+        # Position in a ThreadBlocks, and number of widgets displayed
+        self.chunk = None
+        self.size = 0
+        self.divider = urwid.Divider(" ")
+
     @property
     def date(self):
-        return self[-1].item.published
+        return self[-1].item.published_ts
 
     @property
     def deleted(self):
@@ -43,6 +54,223 @@ class ThreadList(list):
 
     def __eq__(self, other):
         return type(other) is ThreadList and self.id == other.id
+
+    def __hash__(self):
+        return object.__hash__(self)
+# }}}
+# {{{ ThreadBlocks
+class ThreadChunk:
+    __slots__ = ("threads", "idx")
+
+    def __init__(self, threads):
+        self.threads = threads
+        self.idx = 0
+
+class ThreadBlocks:
+    """The threads of a channel, newest first, and the number of widgets
+    each of them displays.
+
+    Threads are stored in chunks of about chunk_size threads, with Fenwick
+    trees of the number of threads and widgets in each chunk. So finding the
+    position of a thread in the flat list of widgets, or the thread at a
+    given position, only takes O(log n + chunk_size) operations, and so does
+    inserting, removing or resizing a thread."""
+
+    chunk_size = 64
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self._chunks = []
+        self._rebuild()
+
+    def _rebuild(self):
+        for (idx, chunk) in enumerate(self._chunks):
+            chunk.idx = idx
+        self._counts = FenwickTree(len(chunk.threads) for chunk in self._chunks)
+        self._sizes = FenwickTree(sum(thr.size for thr in chunk.threads) for chunk in self._chunks)
+
+    def __len__(self):
+        return self._counts.prefix(len(self._chunks))
+
+    def __iter__(self):
+        for chunk in self._chunks:
+            yield from chunk.threads
+
+    @property
+    def total(self):
+        """Number of widgets displayed by all the threads."""
+        return self._sizes.prefix(len(self._chunks))
+
+    def insert(self, thr, size):
+        """Insert a thread at the right position."""
+        thr.size = size
+        if len(self._chunks) == 0:
+            chunk = ThreadChunk([thr])
+            thr.chunk = chunk
+            self._chunks.append(chunk)
+            self._rebuild()
+            return
+
+        # Find the first chunk whose last thread is not newer than thr
+        lo, hi = 0, len(self._chunks) - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._chunks[mid].threads[-1] < thr:
+                lo = mid + 1
+            else:
+                hi = mid
+        chunk = self._chunks[lo]
+        bisect.insort_left(chunk.threads, thr)
+        thr.chunk = chunk
+
+        if len(chunk.threads) > 2 * ThreadBlocks.chunk_size:
+            half = len(chunk.threads) // 2
+            new_chunk = ThreadChunk(chunk.threads[half:])
+            del chunk.threads[half:]
+            for t in new_chunk.threads:
+                t.chunk = new_chunk
+            self._chunks.insert(chunk.idx + 1, new_chunk)
+            self._rebuild()
+        else:
+            self._counts.add(chunk.idx, 1)
+            self._sizes.add(chunk.idx, size)
+
+    def remove(self, thr):
+        chunk = thr.chunk
+        for (idx, t) in enumerate(chunk.threads):
+            if t is thr:
+                del chunk.threads[idx]
+                break
+        thr.chunk = None
+        if len(chunk.threads) == 0:
+            del self._chunks[chunk.idx]
+            self._rebuild()
+        else:
+            self._counts.add(chunk.idx, -1)
+            self._sizes.add(chunk.idx, -thr.size)
+
+    def resize(self, thr, size):
+        """Change the number of widgets displayed by a thread."""
+        self._sizes.add(thr.chunk.idx, size - thr.size)
+        thr.size = size
+
+    def position(self, thr):
+        """Return the position of the first widget of a thread."""
+        chunk = thr.chunk
+        pos = self._sizes.prefix(chunk.idx)
+        for t in chunk.threads:
+            if t is thr:
+                return pos
+            pos += t.size
+
+    def number(self, thr):
+        """Return the index of a thread."""
+        chunk = thr.chunk
+        for (idx, t) in enumerate(chunk.threads):
+            if t is thr:
+                return self._counts.prefix(chunk.idx) + idx
+
+    def locate(self, pos):
+        """Return the thread displaying the widget at a given position, and
+        the position of the widget in the thread."""
+        idx, rest = self._sizes.find(pos)
+        if pos < 0 or idx >= len(self._chunks):
+            raise IndexError(pos)
+        for thr in self._chunks[idx].threads:
+            if rest < thr.size:
+                return (thr, rest)
+            rest -= thr.size
+# }}}
+# {{{ Flat list of widgets
+class FlatThreads:
+    """Read-only view of the widgets displayed by a ThreadsWalker, as a flat
+    list: extra widget, then each thread followed by a divider."""
+
+    def __init__(self, walker):
+        self._walker = walker
+
+    def __len__(self):
+        return self._walker._prefix_size() + self._walker.threads.total
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return list(itertools.islice(self, *idx.indices(len(self))))
+        if idx < 0:
+            idx += len(self)
+        return self._walker._widget_at(idx)
+
+    def __iter__(self):
+        walker = self._walker
+        if walker._prefix_size() > 0:
+            yield walker.extra_widget
+        for thr in walker.threads:
+            for offset in range(thr.size):
+                yield walker._thread_widget(thr, offset)
+
+    def index(self, w):
+        pos = self._walker._position_of(w)
+        if pos is None:
+            raise ValueError("widget is not displayed")
+        return pos
+# }}}
+# {{{ Background channel loading
+class ChannelLoader(threading.Thread):
+    """Read the cached items of a channel in a background thread, and hand
+    them to a ThreadsWalker in the UI thread, newest first, batch by batch.
+
+    The first batch is about a screenful, so that it's displayed as soon as
+    possible. Each batch is only sent once the previous one has been added,
+    so the UI can handle input in between. Loading stops as soon as the
+    walker starts loading another channel."""
+
+    first_batch_size = 50
+    batch_size = 500
+
+    def __init__(self, walker, generation, cache):
+        super().__init__(name="channel loader")
+        self.daemon = True
+        self.walker = walker
+        self.generation = generation
+        self.cache = cache
+        self._batch_done = threading.Event()
+        self.start()
+
+    @property
+    def cancelled(self):
+        return self.walker.generation != self.generation
+
+    def run(self):
+        start = time.monotonic()
+        try:
+            items = self.cache.items
+            pos, size = 0, ChannelLoader.first_batch_size
+            while pos < len(items) and not self.cancelled:
+                batch = items[pos:pos+size]
+                # Parse the first items here rather than in the UI thread
+                if pos == 0:
+                    batch[0].content
+                self._send(self.walker._load_batch, batch)
+                pos += size
+                size = ChannelLoader.batch_size
+        except Exception:
+            log.exception("Could not load the cached items of %s", self.walker.channel.jid)
+        if not self.cancelled:
+            self._send(self.walker._load_done)
+            log.debug("Channel %s loaded in %.3f seconds", self.walker.channel.jid, time.monotonic() - start)
+
+    def _send(self, func, *args):
+        self._batch_done.clear()
+        self.walker.ui.safe_callback(self._apply)(func, args)
+        self._batch_done.wait()
+
+    def _apply(self, func, args):
+        try:
+            if not self.cancelled:
+                func(*args)
+        finally:
+            self._batch_done.set()
 # }}}
 # {{{ ThreadsWalker
 class ThreadsWalker(urwid.ListWalker):
@@ -50,78 +278,148 @@ class ThreadsWalker(urwid.ListWalker):
         super().__init__()
         self.ui = ui
         self.channel = None
+        self.cache = None
         self.more_posts_requested = False
         self.oldest_item = None
         self.items_iterator = None
         self.focus_item = (None, None)
 
-        # Extra widget: new post or new reply
+        # Channel being loaded in the background, if any. The generation is
+        # incremented each time a channel is loaded, to cancel the previous
+        # loader.
+        self.generation = 0
+        self.loader = None
+
+        # Ids of the items removed while loading: the loader may still have
+        # them in its (older) list of cached items
+        self._removed_ids = set()
+
+        # Item waiting to be loaded, and what to do with its position
+        self._wanted_item = None
+
+        # Extra widget: new post or new reply, and the thread it is displayed
+        # in (for replies and edits)
         self.extra_widget = None
+        self.extra_thread = None
         self.focus_before_extra_widget = None
 
-        # A list of ThreadList, newest thread first
-        self.threads = []
-        self.flat_threads = []
+        # The threads, newest thread first, and the flat list of the widgets
+        # they display. Both are updated in place when something changes.
+        self.threads = ThreadBlocks()
+        self.flat_threads = FlatThreads(self)
+
+        # Indexes: thread id -> ThreadList, and post/reply id -> (ThreadList,
+        # widget). Positions and thread numbers come from self.threads.
+        self._threads_by_id = {}
+        self._items_by_id = {}
 
     # {{{ Internal helpers
-    def _modified(self, flatten=True):
-        if flatten:
-            self._flatten()
-            focus_w = self.focus_item[0]
-            if self.focus_item[0] is None or self.focus_item[1] is None:
-                if len(self.flat_threads) > 0:
+    def _modified(self, refocus=True):
+        if refocus:
+            nb_widgets = len(self.flat_threads)
+            focus_w, focus_pos = self.focus_item
+            if focus_w is None or focus_pos is None:
+                if nb_widgets > 0:
                     self.focus_item = (self.flat_threads[0], 0)
                 else:
                     self.focus_item = (None, None)
-            elif self.focus_item[0] is not self.flat_threads[self.focus_item[1]]:
-                # Mismatch - try to keep the widget focused
-                w, pos = self.focus_item
-                try:
-                    pos = self.flat_threads.index(w)
-                except ValueError:
+            else:
+                # Try to keep the widget focused
+                pos = self._position_of(focus_w)
+                if pos is None:
                     # Widget not found - keep position
-                    w = self.flat_threads[pos]
-                self.focus_item = (w, pos)
+                    pos = min(focus_pos, nb_widgets - 1)
+                if pos < 0:
+                    self.focus_item = (None, None)
+                else:
+                    self.focus_item = (self.flat_threads[pos], pos)
         super()._modified()
 
-    def _flatten(self):
-        self.flat_threads = []
-
-        # Handle new post/reply widget
-        reply_thr_id = None
-        if type(self.extra_widget) is NewPostWidget:
-            self.flat_threads = [self.extra_widget]
-        elif type(self.extra_widget) is NewReplyWidget:
-            reply_thr_id = self.extra_widget.thread_id
-
-        # Handle edit post/reply widget
-        edit_thr_id = None
-        if type(self.extra_widget) is EditPostWidget:
-            edit_thr_id = self.extra_widget.orig_id
-        elif type(self.extra_widget) is EditReplyWidget:
-            edit_thr_id = self.extra_widget.orig_thread_id
-
-        for thr in self.threads:
-            # Hide threads with only deleted items
-            if thr.deleted:
-                log.debug("Hiding deleted thread %s", thr.id)
-                continue
-
-            beg = len(self.flat_threads)
-            self.flat_threads.extend(thr)
-            if thr.id == reply_thr_id:
-                self.flat_threads.append(self.extra_widget)
-            elif thr.id == edit_thr_id:
-                # Find item with the same ID as self.extra_widget
-                pos = None
-                for (idx, w) in enumerate(self.flat_threads[beg:]):
-                    if w.id == self.extra_widget.orig_id:
-                        pos = beg + idx + 1
-                        break
-                if pos is not None:
-                    self.flat_threads.insert(pos, self.extra_widget)
-                # TODO: handle pos == None
-            self.flat_threads.append(urwid.Divider(" "))
+    def _prefix_size(self):
+        # A new post widget is displayed on top of the threads
+        return 1 if type(self.extra_widget) is NewPostWidget else 0
+
+    def _block_size(self, thr):
+        # Hide threads with only deleted items
+        if thr.deleted:
+            return 0
+        size = len(thr) + 1
+        if thr is self.extra_thread:
+            size += 1
+        return size
+
+    def _update_thread(self, thr):
+        self.threads.resize(thr, self._block_size(thr))
+
+    def _set_extra_widget(self, w, thr_id=None):
+        old_thr = self.extra_thread
+        self.extra_widget = w
+        self.extra_thread = None
+        if old_thr is not None and old_thr.chunk is not None:
+            self._update_thread(old_thr)
+        if thr_id is not None:
+            thr = self.find_thread_by_id(thr_id)
+            if thr is not None:
+                self.extra_thread = thr
+                self._update_thread(thr)
+
+    def _extra_offset(self):
+        # Position of the extra widget in its thread: after the edited item,
+        # or at the end of the thread
+        thr = self.extra_thread
+        if type(self.extra_widget) in (EditPostWidget, EditReplyWidget):
+            for (idx, w) in enumerate(thr):
+                if w.id == self.extra_widget.orig_id:
+                    return idx + 1
+        return len(thr)
+
+    def _thread_widget(self, thr, offset):
+        if thr is self.extra_thread:
+            extra_offset = self._extra_offset()
+            if offset == extra_offset:
+                return self.extra_widget
+            elif offset > extra_offset:
+                offset -= 1
+        if offset < len(thr):
+            return thr[offset]
+        return thr.divider
+
+    def _widget_at(self, pos):
+        prefix = self._prefix_size()
+        if pos < prefix:
+            return self.extra_widget
+        thr, offset = self.threads.locate(pos - prefix)
+        return self._thread_widget(thr, offset)
+
+    def _thread_of(self, w):
+        # The thread a widget is displayed in, if any
+        if w is self.extra_widget:
+            return self.extra_thread
+        elif isinstance(w, ReplyWidget):
+            thr_id = w.in_reply_to
+        elif isinstance(w, ItemWidget):
+            thr_id = w.id
+        else:
+            return None
+        thr = self.find_thread_by_id(thr_id)
+        if thr is not None and thr.chunk is not None and thr.size > 0:
+            return thr
+
+    def _position_of(self, w):
+        """Return the position of a widget in the flat list, or None if it is
+        not displayed."""
+        if w is None:
+            return None
+        prefix = self._prefix_size()
+        if prefix > 0 and w is self.extra_widget:
+            return 0
+        thr = self._thread_of(w)
+        if thr is None:
+            return None
+        pos = prefix + self.threads.position(thr)
+        for offset in range(thr.size):
+            if self._thread_widget(thr, offset) is w:
+                return pos + offset
     # }}}
     # {{{ ListWalker interface
     def get_focus(self):
@@ -132,11 +430,10 @@ class ThreadsWalker(urwid.ListWalker):
         self.focus_item = (item, position)
 
         # Which thread number is that?
-        for (pos, thr) in enumerate(self.threads):
-            if item in thr:
-                thr_nb = pos+1
-                self.ui.safe_status_set_text("{}: thread {}/{}".format(self.channel.jid, thr_nb, len(self.threads)))
-                break
+        if position >= self._prefix_size():
+            thr, _ = self.threads.locate(position - self._prefix_size())
+            thr_nb = self.threads.number(thr) + 1
+            self.ui.safe_status_set_text("{}: thread {}/{}".format(self.channel.jid, thr_nb, len(self.threads)))
 
         # Avoid placeholders
         w = self.focus_item[0]
@@ -155,9 +452,10 @@ class ThreadsWalker(urwid.ListWalker):
 
     def get_next(self, position):
         # Load new items if we're close to the end of the channel
-        if position >= len(self.flat_threads) - 40:
+        nb_widgets = len(self.flat_threads)
+        if position >= nb_widgets - 40 and self.loader is None:
             self._load_more_posts()
-        if position < len(self.flat_threads)-1:
+        if position < nb_widgets-1:
             return (self.flat_threads[position+1], position+1)
         else:
             return None, None
@@ -165,21 +463,45 @@ class ThreadsWalker(urwid.ListWalker):
     # {{{ Channel management
     def set_channel(self, channel, cache):
         log.info("Loading channel %s", channel.jid)
-        del self.threads[:]
+        self.threads.clear()
+        self._threads_by_id.clear()
+        self._items_by_id.clear()
+        self._removed_ids.clear()
+        self._wanted_item = None
+        subwidgets_cache.clear()
         self.extra_widget = None
+        self.extra_thread = None
         self.channel = channel
+        self.cache = cache
         self.focus_item = (None, None)
 
         self.more_posts_requested = False
         self.oldest_item = None
-        for atom in cache.items:
-            self.add(atom)
         for atom in self.channel:
             self.add(atom)
-        if len(self.threads) < 1:
-            self._load_more_posts()
+        self._modified()
 
+        # Load the cached items in the background
+        self.generation += 1
+        self.loader = ChannelLoader(self, self.generation, cache)
+
+    def _load_batch(self, atoms):
+        for atom in atoms:
+            # Items received from the server are newer than the cached ones,
+            # and removed items must stay removed
+            if atom.id not in self._items_by_id and atom.id not in self._removed_ids:
+                self.add(atom)
         self._modified()
+        if self._wanted_item is not None and self._wanted_item[0] in self._items_by_id:
+            self._found_wanted_item()
+
+    def _load_done(self):
+        self.loader = None
+        self._removed_ids.clear()
+        if self._wanted_item is not None:
+            self._found_wanted_item()
+        if len(self.threads) < 1:
+            self._load_more_posts()
 
     def _load_more_posts(self):
         if not self.more_posts_requested:
@@ -199,12 +521,33 @@ class ThreadsWalker(urwid.ListWalker):
         w = self.focus_item[0]
         if isinstance(w, PostWidget):
             self.ui.channels.goto(w.author)
+
+    def when_item_loaded(self, id_, callback):
+        """Call callback with the position of the post/reply with the
+        specified id (or None if it is not displayed) once the channel is
+        loaded far enough to know it."""
+        if id_ in self._items_by_id or self.loader is None:
+            callback(self.find_item_position(id_))
+        else:
+            self._wanted_item = (id_, callback)
+
+    def _found_wanted_item(self):
+        id_, callback = self._wanted_item
+        self._wanted_item = None
+        callback(self.find_item_position(id_))
+
+    def find_item_position(self, id_):
+        """Return the position of the post/reply with the specified id, or
+        None if it is not displayed."""
+        if id_ in self._items_by_id:
+            _, w = self._items_by_id[id_]
+            return self._position_of(w)
     # }}}
     # {{{ Threads management
     def add(self, item):
         log.debug("Adding item %s", item.id)
         self.more_posts_requested = False
-        if self.oldest_item is None or item.published < self.oldest_item.published:
+        if self.oldest_item is None or item.published_ts < self.oldest_item.published_ts:
             self.oldest_item = item
 
         # Find thread ID
@@ -213,9 +556,9 @@ class ThreadsWalker(urwid.ListWalker):
         if item.object_type == "comment" and item.in_reply_to is not None:
             item_is_post = False
             thr_id = item.in_reply_to
-        pos_thr = self.find_thread_by_id(thr_id)
+        thr = self.find_thread_by_id(thr_id)
 
-        if pos_thr is None:
+        if thr is None:
             # New thread!
             thr = ThreadList()
             if item_is_post:
@@ -225,74 +568,85 @@ class ThreadsWalker(urwid.ListWalker):
                 thr.insert(0, ItemWidget(thr_id, " ", " ", "[post not loaded yet]"))
                 thr.append(ReplyWidget(item))
 
-            bisect.insort_left(self.threads, thr)
+            self._threads_by_id[thr_id] = thr
+            self._items_by_id[item.id] = (thr, thr[-1])
+            self.threads.insert(thr, self._block_size(thr))
 
         else:
-            # New post/reply in existing thread!
-            pos, thr = pos_thr
+            # New post/reply in existing thread! This may change the thread
+            # date, so take it out and insert it again at the right position.
+            self.threads.remove(thr)
             if item_is_post:
                 # Replace placeholder with this one
-                thr[0] = PostWidget(item)
+                w = PostWidget(item)
+                thr[0] = w
             else:
-                # Add reply at the right position. A simple bisect.insort_left()
-                # should be enough, but since a reply may already have been
-                # loaded previously by _load_thread(), we need to be a little
-                # more careful.
+                # Add reply at the right position. A reply may already have
+                # been loaded previously by _load_thread(), so remove it
+                # first.
+                old = self._items_by_id.get(item.id)
+                if old is not None and old[0] is thr:
+                    self._del_widget(thr, old[1])
                 w = ReplyWidget(item)
-                reply_pos = bisect.bisect_left(thr, w, lo=1)
-                if reply_pos >= len(thr):
-                    thr.append(w)
-                elif thr[reply_pos].id != item.id:
-                    thr.insert(reply_pos, w)
-                else:
-                    thr[reply_pos] = w
-
-            # This may have changed the thread date, so we need to recompute its position in the list
-            new_pos = bisect.bisect_left(self.threads, thr)
-            if new_pos < pos:
-                del self.threads[pos]
-                self.threads.insert(new_pos, thr)
-            elif new_pos > pos:
-                self.threads.insert(new_pos, thr)
-                del self.threads[pos]
+                bisect.insort_left(thr, w, lo=1)
+            self._items_by_id[item.id] = (thr, w)
+            self.threads.insert(thr, self._block_size(thr))
 
     def find_thread_by_id(self, thr_id):
-        for pos, thr in enumerate(self.threads):
-            if thr.id == thr_id:
-                return (pos, thr)
+        return self._threads_by_id.get(thr_id)
+
+    def _del_widget(self, thr, w):
+        for (idx, w2) in enumerate(thr):
+            if w2 is w:
+                del thr[idx]
+                return
 
     def remove(self, id_):
         log.debug("Removing item %s", id_)
         focus_pos = self.focus_item[1]
+        if self.loader is not None:
+            self._removed_ids.add(id_)
 
         # Find post/reply with specified id
-        for (i, thr) in enumerate(self.threads):
-            for (j, w) in enumerate(thr):
-                if w.id == id_:
-                    # Remove item from thread
-                    del thr[j]
-
-                    # Remove empty threads and threads with just a placeholder
-                    if len(thr) == 0 or (len(thr) == 1 and type(thr[0]) is ItemWidget):
-                        del self.threads[i]
-
-                    # Add a placeholder for threads without a post
-                    elif type(w) is PostWidget:
-                        thr.insert(0, ItemWidget(id_, " ", " ", "[post deleted]"))
-
-                    # Give focus back to something that exists
-                    self._flatten()
-                    self.set_focus(focus_pos)
-                    if type(self.focus_item[0]) is urwid.Divider:
-                        pos = max(0, focus_pos-1)
-                        self.set_focus(pos)
-                    return
+        if id_ not in self._items_by_id:
+            return
+        thr, w = self._items_by_id.pop(id_)
+
+        # Remove item from thread
+        thr_id = thr.id
+        self._del_widget(thr, w)
+        self.threads.remove(thr)
+
+        # Remove empty threads and threads with just a placeholder
+        if len(thr) == 0 or (len(thr) == 1 and type(thr[0]) is ItemWidget):
+            del self._threads_by_id[thr_id]
+            if thr is self.extra_thread:
+                self.extra_thread = None
+
+        else:
+            # Add a placeholder for threads without a post
+            if type(w) is PostWidget:
+                thr.insert(0, ItemWidget(id_, " ", " ", "[post deleted]"))
+
+            # The thread date may have changed too
+            self.threads.insert(thr, self._block_size(thr))
+
+        # Give focus back to something that exists
+        nb_widgets = len(self.flat_threads)
+        if nb_widgets == 0 or focus_pos is None:
+            self.focus_item = (None, None)
+            return
+        focus_pos = min(focus_pos, nb_widgets-1)
+        self.set_focus(focus_pos)
+        if type(self.focus_item[0]) is urwid.Divider:
+            pos = max(0, focus_pos-1)
+            self.set_focus(pos)
     # }}}
     # {{{ New post/reply management
     def new_post(self):
         """Create a NewPostWidget and put it on top of the posts list."""
         self.focus_before_extra_widget = self.focus_item
-        self.extra_widget = NewPostWidget(self.ui, self.channel)
+        self._set_extra_widget(NewPostWidget(self.ui, self.channel))
         self._modified()
 
     def new_reply(self):
@@ -310,7 +664,7 @@ class ThreadsWalker(urwid.ListWalker):
             return
 
         self.focus_before_extra_widget = self.focus_item
-        self.extra_widget = NewReplyWidget(self.ui, self.channel, thr_id)
+        self._set_extra_widget(NewReplyWidget(self.ui, self.channel, thr_id), thr_id)
         self._modified()
         return self.flat_threads.index(self.extra_widget)
 
@@ -329,15 +683,17 @@ class ThreadsWalker(urwid.ListWalker):
 
         self.focus_before_extra_widget = self.focus_item
         if hasattr(focus_w, "in_reply_to"):
-            self.extra_widget = EditReplyWidget(self.ui, self.channel, item_text, item_author, item_id, focus_w.in_reply_to)
+            w = EditReplyWidget(self.ui, self.channel, item_text, item_author, item_id, focus_w.in_reply_to)
+            self._set_extra_widget(w, w.orig_thread_id)
         else:
-            self.extra_widget = EditPostWidget(self.ui, self.channel, item_text, item_author, item_id)
+            w = EditPostWidget(self.ui, self.channel, item_text, item_author, item_id)
+            self._set_extra_widget(w, w.orig_id)
         self._modified()
         return self.flat_threads.index(self.extra_widget)
 
     def remove_extra_widget(self):
         if self.extra_widget is not None:
-            self.extra_widget = None
+            self._set_extra_widget(None)
             self.ui.status.set_text("")
             self.focus_item = self.focus_before_extra_widget
             self._modified()
@@ -367,6 +723,9 @@ class ThreadsBox(urwid.ListBox):
         self.content = ThreadsWalker(ui)
         self._pref_col = 0
         self.top_item = None
+        self.search_query = None
+        self.search_hits = []
+        self.search_pos = 0
         super().__init__(self.content)
 
     def render(self, size, focus=False):
@@ -389,13 +748,16 @@ class ThreadsBox(urwid.ListBox):
                 if focus[0] is not None:
                     _, focus_rows = focus[0].pack((maxcol,), True)
 
+                # We don't want the focused widget to be hidden, so we can't
+                # shift focus by more than (maxrow - focus_rows) lines: stop
+                # counting as soon as we know it won't be possible.
                 nb_rows = 0
-                for w in self.content.flat_threads[0:focus[1]]:
+                for w in itertools.islice(self.content.flat_threads, focus[1]):
                     _, rows = w.pack((maxcol,), False)
                     nb_rows += rows
+                    if nb_rows >= maxrow - focus_rows:
+                        break
 
-                # We don't want the focused widget to be hidden, so we can't
-                # shift focus by more than (maxrow - focus_rows) lines.
                 if nb_rows < maxrow - focus_rows:
                     log.debug("Shifting focus by %d lines (ListBox: %d lines, focused widget: %d lines)", nb_rows, maxrow, focus_rows)
                     self.shift_focus(size, nb_rows)
@@ -440,6 +802,10 @@ class ThreadsBox(urwid.ListBox):
             self.update_status()
         elif key == "t":
             self.update_title()
+        elif key == "/":
+            self.search()
+        elif key == ".":
+            self.goto_search_hit(self.search_pos + 1)
         else:
             return key
 
@@ -477,6 +843,42 @@ class ThreadsBox(urwid.ListBox):
         self.top_item = None
         self.content.set_channel(channel, cache)
 
+    def search(self):
+        def _search(text):
+            text = text.strip()
+            if len(text) == 0 or self.content.cache is None:
+                return
+            log.info("Searching for %s", text)
+            self.search_query = text
+            self.search_hits = self.content.cache.search(text)
+            if len(self.search_hits) == 0:
+                self.ui.status.set_text("No results for \"{}\"".format(text))
+            else:
+                self.goto_search_hit(0)
+        self.ui.status.ask("Search: ", _search)
+
+    def goto_search_hit(self, idx):
+        """Go to a search result, switching channel if needed."""
+        if len(self.search_hits) == 0:
+            return
+        self.search_pos = idx % len(self.search_hits)
+        jid, id_ = self.search_hits[self.search_pos]
+        if self.content.channel is None or self.content.channel.jid != jid:
+            self.ui.channels.goto(jid)
+
+        msg = "Result {}/{} for \"{}\"".format(self.search_pos+1, len(self.search_hits), self.search_query)
+        def _goto(pos):
+            if pos is None:
+                status = msg + " is not displayed"
+            else:
+                self.set_focus(pos, coming_from="above")
+                status = msg
+            # Queued, so that it comes after the thread number set by set_focus()
+            self.ui.safe_status_set_text(status + " [. for next result]")
+
+        # The channel may still be loading
+        self.content.when_item_loaded(id_, _goto)
+
     def update_description(self):
         def _set_desc(text):
             text = text.strip()
@@ -23,6 +23,7 @@ import urwid
 
 import bccc.client
 from bccc.ui import ChannelsList, ThreadsBox
+from .cache import cache_stats, configure as configure_cache, flush_scheduler
 from .util import SmartStatusBar
 
 log = logging.getLogger(__name__)
@@ -86,6 +87,9 @@ class UI:
         client_thread.daemon = True
         client_thread.start()
         # }}}
+        # {{{ Cache
+        configure_cache(conf)
+        # }}}
         # {{{ Palette
         palette = []
         for key, val in theme.items():
@@ -169,6 +173,8 @@ class UI:
 
         # About to exit: do some cleanup
         self.client.disconnect()
+        flush_scheduler.stop()
+        cache_stats.dump()
         print("Bye bye!", file=sys.stderr)
 
     def input_filter(self, keys, raw):
@@ -182,6 +188,9 @@ class UI:
             self.loop.draw_screen()
         elif input == "g":
             self.channels.goto()
+        elif input == "I":
+            cache_stats.dump()
+            self.status.set_text("Cache statistics written to the log")
     # }}}
     # {{{ Thread-safe callbacks and requests
     def refresh(self):
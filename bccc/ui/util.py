@@ -96,6 +96,50 @@ class SmartStatusBar(urwid.WidgetWrap):
         else:
             return super().keypress(size, key)
 # }}}
+# {{{ Fenwick tree
+class FenwickTree:
+    """A list of numbers with O(log n) updates, prefix sums and searches."""
+
+    def __init__(self, values=()):
+        self._tree = [0] + list(values)
+        n = len(self._tree)
+        for i in range(1, n):
+            j = i + (i & -i)
+            if j < n:
+                self._tree[j] += self._tree[i]
+
+    def __len__(self):
+        return len(self._tree) - 1
+
+    def add(self, idx, delta):
+        """Add delta to the value at index idx."""
+        i = idx + 1
+        while i < len(self._tree):
+            self._tree[i] += delta
+            i += i & -i
+
+    def prefix(self, idx):
+        """Return the sum of the values before index idx."""
+        total = 0
+        while idx > 0:
+            total += self._tree[idx]
+            idx -= idx & -idx
+        return total
+
+    def find(self, value):
+        """Return (idx, rest) such that prefix(idx) + rest == value and
+        rest < values[idx], or (len(self), rest) if value is greater than
+        the sum of all the values. The values must not be negative."""
+        idx, step = 0, 1
+        while step * 2 < len(self._tree):
+            step *= 2
+        while step > 0:
+            if idx + step < len(self._tree) and self._tree[idx + step] <= value:
+                idx += step
+                value -= self._tree[idx]
+            step //= 2
+        return (idx, value)
+# }}}
 # {{{ URLs extractor
 # From http://daringfireball.net/2010/07/improved_regex_for_matching_urls
 URL_RE = re.compile(r"""(?i)\b((?:[a-z][\w-]+:(?:/{1,3}|[a-z0-9%])|www\d{0,3}[.]|[a-z0-9.\-]+[.][a-z]{2,4}/)(?:[^\s()<>]+|\(([^\s()<>]+|(\([^\s()<>]+\)))*\))+(?:\(([^\s()<>]+|(\([^\s()<>]+\)))*\)|[^\s`!()\[\]{};:'".,<>?«»“”‘’]))""")
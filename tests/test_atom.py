@@ -0,0 +1,175 @@
+# Copyright 2012 Thomas Jost
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software stributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+import unittest
+import xml.etree.ElementTree as ET
+
+from bccc.client.atom import ATOM_NS, AS_NS, AtomError, UpdatableAtomsList
+
+def make_entry(id_, day, object_type="note"):
+    """Build a minimal post entry, published on the given day of 2012-01."""
+    entry = ET.Element("{{{}}}entry".format(ATOM_NS))
+    ET.SubElement(entry, "{{{}}}id".format(ATOM_NS)).text = id_
+    author = ET.SubElement(entry, "{{{}}}author".format(ATOM_NS))
+    ET.SubElement(author, "{{{}}}name".format(ATOM_NS)).text = "user@example.com"
+    ET.SubElement(entry, "{{{}}}content".format(ATOM_NS)).text = "Post " + id_
+    ET.SubElement(entry, "{{{}}}published".format(ATOM_NS)).text = "2012-01-{:02d}T12:00:00Z".format(day)
+    obj = ET.SubElement(entry, "{{{}}}object".format(AS_NS))
+    ET.SubElement(obj, "{{{}}}object-type".format(AS_NS)).text = object_type
+    return entry
+
+class UpdatableAtomsListTest(unittest.TestCase):
+    def setUp(self):
+        # Newest first: a5, a4, a3, a2, a1 (published on days 15 to 11)
+        self.lst = UpdatableAtomsList()
+        for n in range(1, 6):
+            self.lst.add(make_entry("a{}".format(n), 10 + n))
+
+    def ids(self, atoms):
+        return [a.id for a in atoms]
+
+    def rest(self, it):
+        # The ids of the atoms left in an iterator
+        ids = []
+        while True:
+            try:
+                ids.append(next(it).id)
+            except StopIteration:
+                return ids
+
+    def test_sorted_newest_first(self):
+        self.assertEqual(self.ids(self.lst), ["a5", "a4", "a3", "a2", "a1"])
+        self.assertEqual(len(self.lst), 5)
+
+    # {{{ remove()
+    def test_remove_before_iterator(self):
+        it = iter(self.lst)
+        self.assertEqual(self.ids([next(it), next(it)]), ["a5", "a4"])
+        self.lst.remove("a5")
+        self.assertEqual(self.rest(it), ["a3", "a2", "a1"])
+
+    def test_remove_at_iterator(self):
+        it = iter(self.lst)
+        self.assertEqual(self.ids([next(it), next(it)]), ["a5", "a4"])
+        self.lst.remove("a4")
+        self.assertEqual(self.rest(it), ["a3", "a2", "a1"])
+
+    def test_remove_after_iterator(self):
+        it = iter(self.lst)
+        self.assertEqual(next(it).id, "a5")
+        self.lst.remove("a3")
+        self.assertEqual(it.atoms_left(), 3)
+        self.assertEqual(self.rest(it), ["a4", "a2", "a1"])
+
+    def test_remove_unknown(self):
+        it = iter(self.lst)
+        next(it)
+        self.lst.remove("nope")
+        self.assertEqual(self.rest(it), ["a4", "a3", "a2", "a1"])
+    # }}}
+    # {{{ add()
+    def test_add_new_before_iterator(self):
+        it = iter(self.lst)
+        self.assertEqual(self.ids([next(it), next(it)]), ["a5", "a4"])
+        self.lst.add(make_entry("a6", 16))
+        self.assertEqual(self.rest(it), ["a3", "a2", "a1"])
+        self.assertEqual(self.ids(self.lst), ["a6", "a5", "a4", "a3", "a2", "a1"])
+
+    def test_add_updated_after_iterator(self):
+        it = iter(self.lst)
+        self.assertEqual(self.ids([next(it), next(it)]), ["a5", "a4"])
+        a = self.lst.add(make_entry("a2", 20))
+        self.assertEqual(a.id, "a2")
+        self.assertEqual(self.rest(it), ["a3", "a1"])
+        self.assertEqual(self.ids(self.lst), ["a2", "a5", "a4", "a3", "a1"])
+        self.assertEqual(len(self.lst), 5)
+
+    def test_add_replaces_current_atom(self):
+        it = iter(self.lst)
+        self.assertEqual(self.ids([next(it), next(it)]), ["a5", "a4"])
+        self.lst.add(make_entry("a4", 20))
+        self.assertEqual(self.ids(self.lst), ["a4", "a5", "a3", "a2", "a1"])
+        self.assertEqual(self.rest(it), ["a3", "a2", "a1"])
+
+    def test_add_replaces_current_atom_later(self):
+        it = iter(self.lst)
+        self.assertEqual(self.ids([next(it), next(it)]), ["a5", "a4"])
+        self.lst.add(make_entry("a4", 1))
+        self.assertEqual(self.ids(self.lst), ["a5", "a3", "a2", "a1", "a4"])
+        self.assertEqual(self.rest(it), ["a3", "a2", "a1", "a4"])
+
+    def test_add_unknown_type(self):
+        it = iter(self.lst)
+        next(it)
+        self.assertRaises(AtomError, self.lst.add, make_entry("a6", 16, "comment-ish"))
+        self.assertEqual(len(self.lst), 5)
+        self.assertEqual(self.rest(it), ["a4", "a3", "a2", "a1"])
+    # }}}
+    # {{{ add_many()
+    def test_add_many_new_before_iterator(self):
+        it = iter(self.lst)
+        self.assertEqual(self.ids([next(it), next(it)]), ["a5", "a4"])
+        self.lst.add_many([make_entry("a6", 16)])
+        self.assertEqual(self.rest(it), ["a3", "a2", "a1"])
+        self.assertEqual(self.ids(self.lst), ["a6", "a5", "a4", "a3", "a2", "a1"])
+
+    def test_add_many_updated_after_iterator(self):
+        # a2 is updated and becomes the newest atom: the iterator has not seen
+        # it yet, but it moved before the iterator position
+        it = iter(self.lst)
+        self.assertEqual(self.ids([next(it), next(it)]), ["a5", "a4"])
+        atoms = self.lst.add_many([make_entry("a2", 20)])
+        self.assertEqual(self.ids(atoms), ["a2"])
+        self.assertEqual(self.rest(it), ["a3", "a1"])
+        self.assertEqual(self.ids(self.lst), ["a2", "a5", "a4", "a3", "a1"])
+        self.assertEqual(len(self.lst), 5)
+
+    def test_add_many_updated_before_iterator(self):
+        # a5 was already seen, and is updated to become the oldest atom: the
+        # iterator sees the new version when it gets there
+        it = iter(self.lst)
+        self.assertEqual(self.ids([next(it), next(it)]), ["a5", "a4"])
+        self.lst.add_many([make_entry("a5", 1)])
+        self.assertEqual(self.ids(self.lst), ["a4", "a3", "a2", "a1", "a5"])
+        self.assertEqual(self.rest(it), ["a3", "a2", "a1", "a5"])
+
+    def test_add_many_replaces_current_atom(self):
+        it = iter(self.lst)
+        self.assertEqual(self.ids([next(it), next(it)]), ["a5", "a4"])
+        new_a4 = make_entry("a4", 20)
+        self.lst.add_many([new_a4])
+        self.assertEqual(self.ids(self.lst), ["a4", "a5", "a3", "a2", "a1"])
+        # The iterator goes on after the atom it was on
+        self.assertEqual(self.rest(it), ["a3", "a2", "a1"])
+
+    def test_add_many_replaces_current_atom_later(self):
+        it = iter(self.lst)
+        self.assertEqual(self.ids([next(it), next(it)]), ["a5", "a4"])
+        self.lst.add_many([make_entry("a4", 1)])
+        self.assertEqual(self.ids(self.lst), ["a5", "a3", "a2", "a1", "a4"])
+        # The new version of the current atom is seen again, at its new place
+        self.assertEqual(self.rest(it), ["a3", "a2", "a1", "a4"])
+
+    def test_add_many_duplicates(self):
+        atoms = self.lst.add_many([make_entry("a7", 17), make_entry("a7", 18)])
+        self.assertEqual(len(atoms), 1)
+        self.assertEqual(self.lst[0].published.day, 18)
+        self.assertEqual(len(self.lst), 6)
+    # }}}
+
+if __name__ == "__main__":
+    unittest.main()
+
+# Local Variables:
+# mode: python3
+# End: